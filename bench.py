@@ -0,0 +1,231 @@
+"""Reproducible benchmark for the remove-bg pipeline.
+
+Runs synthetic images of several sizes and formats through /remove-bg via the
+Flask test client and through each pipeline stage directly, then reports
+throughput, p50/p95/p99 latency and peak RSS as JSON.
+
+    python bench.py run --output bench_output.txt
+    python bench.py compare base.json new.json --threshold 10
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import threading
+import time
+
+DEFAULT_SIZES = (320, 800, 1600, 3200)
+DEFAULT_FORMATS = ("JPEG", "PNG", "WEBP")
+STAGES = ("decode", "resize", "inference", "upsample", "composite", "encode")
+
+def make_image(size: int, fmt: str, seed: int = 0) -> bytes:
+    """Deterministic synthetic photo: gradient background, noisy subject ellipse."""
+    import numpy as np
+    from PIL import Image, ImageDraw
+
+    rng = np.random.default_rng(seed + size)
+    w, h = size, size * 3 // 4
+    x = np.linspace(0, 255, w, dtype=np.float32)
+    y = np.linspace(0, 255, h, dtype=np.float32)[:, None]
+    bg = np.stack([np.broadcast_to(x, (h, w)), np.broadcast_to(y, (h, w)), np.full((h, w), 128.0)], axis=2)
+    img = Image.fromarray(bg.astype(np.uint8), "RGB")
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((w * 0.25, h * 0.15, w * 0.75, h * 0.9), fill=(200, 60, 40))
+    noisy = np.asarray(img, dtype=np.int16) + rng.integers(-12, 12, (h, w, 3), dtype=np.int16)
+    img = Image.fromarray(noisy.clip(0, 255).astype(np.uint8), "RGB")
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **({"quality": 90} if fmt in ("JPEG", "WEBP") else {}))
+    return buf.getvalue()
+
+def percentile(samples, pct: float) -> float:
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * pct / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def summarize(latencies, wall: float) -> dict:
+    ms = [t * 1000 for t in latencies]
+    return {
+        "n": len(ms),
+        "throughput_per_s": round(len(ms) / wall, 3) if wall else 0.0,
+        "mean_ms": round(sum(ms) / len(ms), 3) if ms else 0.0,
+        "p50_ms": round(percentile(ms, 50), 3),
+        "p95_ms": round(percentile(ms, 95), 3),
+        "p99_ms": round(percentile(ms, 99), 3),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+def bench_client(server, data: bytes, iterations: int, concurrency: int, params: dict) -> dict:
+    """Drive /remove-bg through the Flask test client from `concurrency` threads.
+
+    Exits non-zero if any request fails, rather than reporting timings of a partial run.
+    """
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(iterations))
+
+    def worker():
+        client = server.app.test_client()
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.perf_counter()
+            try:
+                resp = client.post("/remove-bg", data=dict(params, image=(io.BytesIO(data), "bench")),
+                                   content_type="multipart/form-data")
+            except Exception as e:
+                with lock:
+                    errors.append(f"/remove-bg raised {e!r}")
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                if resp.status_code != 200:
+                    errors.append(f"/remove-bg returned {resp.status_code}: {resp.get_data(as_text=True)}")
+                else:
+                    latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - start
+    if errors:
+        raise SystemExit(f"{len(errors)} of {iterations} requests failed, first: {errors[0]}")
+    return summarize(latencies, wall)
+
+def bench_stages(server, data: bytes, iterations: int) -> dict:
+    """Time each pipeline stage in isolation, calling the server's own functions."""
+    from PIL import Image
+
+    runtime = server.model_registry.get(server.DEFAULT_MODEL)
+    timings = {stage: [] for stage in STAGES}
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        img = Image.open(io.BytesIO(data))
+        draft = server._draft_size(img.format, img.size, server.MAX_DIM)
+        if draft is not None:
+            img.draft(None, draft)
+        img.load()
+        t1 = time.perf_counter()
+        img = server.downscale_if_needed(img, max_dim=server.MAX_DIM)
+        small = server._inference_copy(img, server.DEFAULT_MODEL)
+        t2 = time.perf_counter()
+        with runtime.pool.checkout() as sess:
+            mask = server._infer_masks(sess, [small])[0]
+        t3 = time.perf_counter()
+        mask = server._upsample_mask(mask, img.size)
+        t4 = time.perf_counter()
+        out_img = server._composite(img, mask)
+        t5 = time.perf_counter()
+        server._encode(out_img, "png")
+        t6 = time.perf_counter()
+        for stage, dt in zip(STAGES, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4, t6 - t5)):
+            timings[stage].append(dt)
+    return {stage: summarize(samples, sum(samples)) for stage, samples in timings.items()}
+
+def run(args) -> dict:
+    # Every iteration must do the full work, so keep the result cache out of the way.
+    # Set here rather than at import: loadtest.py and quantize.py import this module too.
+    os.environ["RESULT_CACHE_MAX_MB"] = "0"
+    os.environ.pop("RESULT_CACHE_DIR", None)
+    import server
+
+    if not server.ready_event.wait(args.ready_timeout):
+        raise SystemExit("Model did not become ready in time")
+    if server.preload_error:
+        raise SystemExit(f"Model preload failed: {server.preload_error}")
+
+    random.seed(args.seed)
+    results = {}
+    for fmt in args.formats:
+        for size in args.sizes:
+            data = make_image(size, fmt, args.seed)
+            # Warm caches and allocators before measuring
+            bench_client(server, data, 1, 1, {})
+            name = f"{fmt.lower()}/{size}"
+            results[f"client/{name}"] = bench_client(server, data, args.iterations, args.concurrency, {})
+            for stage, summary in bench_stages(server, data, args.iterations).items():
+                results[f"stage/{stage}/{name}"] = summary
+            print(f"{name}: p50 {results[f'client/{name}']['p50_ms']:.1f} ms", file=sys.stderr)
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+            "env": {k: v for k, v in os.environ.items() if k.startswith(("OMP_", "SESSION_", "BATCH_", "REMBG_", "PNG_", "WEBP_", "MAX_OUTPUT_", "INFERENCE_"))},
+        },
+        "results": results,
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+def compare(base: dict, new: dict, threshold: float, metrics=("p50_ms", "p95_ms", "p99_ms")) -> list:
+    """Return (case, metric, base, new, change %) rows, flagging changes beyond threshold percent."""
+    rows = []
+    for case in sorted(set(base["results"]) & set(new["results"])):
+        for metric in metrics:
+            a, b = base["results"][case][metric], new["results"][case][metric]
+            change = (b - a) / a * 100 if a else 0.0
+            rows.append((case, metric, a, b, change, change > threshold))
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_p = sub.add_parser("run", help="run the benchmark and emit JSON")
+    run_p.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES))
+    run_p.add_argument("--formats", nargs="+", default=list(DEFAULT_FORMATS), type=str.upper)
+    run_p.add_argument("--iterations", type=int, default=20)
+    run_p.add_argument("--concurrency", type=int, default=1)
+    run_p.add_argument("--seed", type=int, default=0)
+    run_p.add_argument("--ready-timeout", type=float, default=300)
+    run_p.add_argument("--output", help="write JSON here instead of stdout")
+
+    cmp_p = sub.add_parser("compare", help="compare two benchmark JSON files")
+    cmp_p.add_argument("base")
+    cmp_p.add_argument("new")
+    cmp_p.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+
+    args = parser.parse_args(argv)
+    if args.command == "run":
+        report = json.dumps(run(args), indent=2)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(report + "\n")
+        else:
+            print(report)
+        return 0
+
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    rows = compare(base, new, args.threshold)
+    for case, metric, a, b, change, regressed in rows:
+        flag = "  REGRESSION" if regressed else ""
+        print(f"{case:40s} {metric:7s} {a:10.2f} -> {b:10.2f} ms ({change:+6.1f}%){flag}")
+    regressions = sum(1 for row in rows if row[-1])
+    print(f"{regressions} regression(s) beyond {args.threshold:g}%")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,36 @@
+"""Gunicorn settings for the service.
+
+With preload_app the master imports the app and, once it is listening on the
+port, loads the default model before forking, so workers share the model
+weights copy-on-write instead of each loading its own copy. rembg itself is
+imported by each worker after the fork. Set GUNICORN_PRELOAD=0 to load the
+model in every worker instead (needed for SESSION_THREADS > 1).
+
+Limits such as CONCURRENT_MEGAPIXELS and the caches are per worker process,
+so size them for WEB_CONCURRENCY copies.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "4"))
+timeout = 180
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") != "0"
+
+if preload_app:
+    # The master loads the model in when_ready rather than in the import-time thread,
+    # and shared sessions must not own ONNX Runtime thread pools
+    os.environ["REMBG_DEFER_PRELOAD"] = "1"
+    os.environ.setdefault("SESSION_THREADS", "1")
+
+def when_ready(arbiter):
+    # Runs after the listeners are bound, so the port is open while the model loads;
+    # connections wait in the backlog until the workers are forked
+    if preload_app:
+        import server
+        server.preload_for_fork()
+
+def post_fork(arbiter, worker):
+    if preload_app:
+        import server
+        server.import_rembg_after_fork()
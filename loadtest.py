@@ -0,0 +1,243 @@
+"""Load generator for /remove-bg against a locally started gunicorn.
+
+Sends requests with Poisson or bursty arrivals, caps in-flight requests at
+--concurrency, mixes image sizes and formats, and records tail latency, 503
+rate and batch queue depth over time as JSON.
+
+The queue depth is a per-process gauge and each /metrics scrape reaches one
+gunicorn worker, so every sample is tagged with that worker's pid and
+depths are never added up across workers.
+
+    python loadtest.py --rate 8 --duration 60 --concurrency 16 --workers 1 --threads 8
+    python loadtest.py --url http://127.0.0.1:5000 --arrival burst --burst-size 20
+"""
+import argparse
+import json
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+from bench import make_image, percentile
+
+QUEUE_DEPTH_RE = re.compile(r"^removebg_batch_queue_depth (\S+)$", re.MULTILINE)
+WORKER_PID_RE = re.compile(r"^removebg_worker_pid (\S+)$", re.MULTILINE)
+
+def parse_mix(spec: str):
+    """Parse 'jpeg:800:3,png:1600:1' into [(format, size, weight), ...]."""
+    mix = []
+    for item in spec.split(","):
+        fmt, size, weight = (item.split(":") + ["1"])[:3]
+        mix.append((fmt.upper(), int(size), float(weight)))
+    return mix
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_gunicorn(args, port: int) -> subprocess.Popen:
+    cmd = [sys.executable, "-m", "gunicorn", "server:app", "--bind", f"127.0.0.1:{port}",
+           "--workers", str(args.workers), "--threads", str(args.threads), "--timeout", "180"]
+    if args.gunicorn_config:
+        cmd += ["--config", args.gunicorn_config]
+    # The image mix repeats identical uploads, so keep the result cache from answering them
+    env = dict(os.environ, RESULT_CACHE_MAX_MB="0")
+    env.pop("RESULT_CACHE_DIR", None)
+    if args.omp_threads:
+        env["OMP_NUM_THREADS"] = env["SESSION_THREADS"] = str(args.omp_threads)
+    # Sessions shared pre-fork must run single-threaded (see gunicorn.conf.py), so more
+    # threads per session means loading the model in each worker
+    if args.no_preload or (args.omp_threads or 1) > 1:
+        env["GUNICORN_PRELOAD"] = "0"
+    return subprocess.Popen(cmd, cwd=os.path.dirname(os.path.abspath(__file__)), env=env)
+
+def wait_ready(url: str, timeout: float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/ready", timeout=5) as resp:
+                if json.load(resp).get("ready"):
+                    return
+        except (OSError, ValueError):
+            pass
+        time.sleep(0.5)
+    raise SystemExit(f"Server at {url} did not become ready within {timeout:g}s")
+
+def multipart(data: bytes, fields: dict):
+    boundary = uuid.uuid4().hex
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{k}"\r\n\r\n{v}\r\n'.encode()
+             for k, v in fields.items()]
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="load"\r\n'
+                 f"Content-Type: application/octet-stream\r\n\r\n".encode() + data + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+def arrivals(args, rng: random.Random):
+    """Yield send offsets in seconds from the start of the run."""
+    t = 0.0
+    while t < args.duration:
+        if args.arrival == "poisson":
+            t += rng.expovariate(args.rate)
+            yield t
+        else:
+            # Bursts of burst_size back-to-back requests, spaced to average out at `rate`
+            for _ in range(args.burst_size):
+                yield t
+            t += args.burst_size / args.rate
+
+def run(args) -> dict:
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    images = {(fmt, size): make_image(size, fmt, args.seed) for fmt, size, _ in mix}
+    weights = [w for _, _, w in mix]
+    params = dict(p.split("=", 1) for p in args.param)
+
+    proc = None
+    url = args.url
+    if not url:
+        port = free_port()
+        proc = start_gunicorn(args, port)
+        url = f"http://127.0.0.1:{port}"
+    try:
+        wait_ready(url, args.ready_timeout)
+        records, queue_samples = [], []
+        lock = threading.Lock()
+        slots = threading.BoundedSemaphore(args.concurrency)
+        stop = threading.Event()
+
+        def send(offset: float, key):
+            body, content_type = multipart(images[key], params)
+            req = urllib.request.Request(f"{url}/remove-bg", data=body, method="POST",
+                                         headers={"Content-Type": content_type})
+            start = time.monotonic()
+            try:
+                with urllib.request.urlopen(req, timeout=args.request_timeout) as resp:
+                    resp.read()
+                    status = resp.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            except OSError:
+                status = 0
+            finally:
+                slots.release()
+            with lock:
+                records.append({"t": offset, "key": f"{key[0].lower()}/{key[1]}", "status": status,
+                                "latency": time.monotonic() - start})
+
+        def sample_queue(t0: float):
+            while not stop.wait(args.sample_interval):
+                try:
+                    with urllib.request.urlopen(f"{url}/metrics", timeout=5) as resp:
+                        text = resp.read().decode()
+                except OSError:
+                    continue
+                match, pid = QUEUE_DEPTH_RE.search(text), WORKER_PID_RE.search(text)
+                if match:
+                    queue_samples.append({"t": round(time.monotonic() - t0, 2),
+                                          "pid": int(float(pid.group(1))) if pid else None,
+                                          "depth": float(match.group(1))})
+
+        t0 = time.monotonic()
+        sampler = threading.Thread(target=sample_queue, args=(t0,), daemon=True)
+        sampler.start()
+        threads, dropped = [], 0
+        for offset in arrivals(args, rng):
+            delay = t0 + offset - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            # Client-side concurrency cap: arrivals beyond it are counted as dropped
+            if not slots.acquire(blocking=False):
+                dropped += 1
+                continue
+            key = rng.choices(list(images), weights)[0]
+            t = threading.Thread(target=send, args=(offset, key), daemon=True)
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        stop.set()
+        return report(args, records, queue_samples, dropped, time.monotonic() - t0)
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(timeout=30)
+
+def summarize(records, wall: float) -> dict:
+    ok = [r["latency"] * 1000 for r in records if r["status"] == 200]
+    n = len(records)
+    return {
+        "requests": n,
+        "ok": len(ok),
+        "throughput_per_s": round(len(ok) / wall, 3) if wall else 0.0,
+        "rate_503": round(sum(r["status"] == 503 for r in records) / n, 4) if n else 0.0,
+        "error_rate": round(sum(r["status"] not in (200, 503) for r in records) / n, 4) if n else 0.0,
+        "p50_ms": round(percentile(ok, 50), 1),
+        "p95_ms": round(percentile(ok, 95), 1),
+        "p99_ms": round(percentile(ok, 99), 1),
+        "max_ms": round(max(ok), 1) if ok else 0.0,
+    }
+
+def report(args, records, queue_samples, dropped: int, wall: float) -> dict:
+    timeline = []
+    for start in range(0, int(wall) + 1, max(1, int(args.window))):
+        window = [r for r in records if start <= r["t"] < start + args.window]
+        samples = [q for q in queue_samples if start <= q["t"] < start + args.window]
+        entry = summarize(window, args.window)
+        entry["t"] = start
+        # Deepest single-worker queue seen in the window, and how many workers were sampled
+        entry["queue_depth_max"] = max(q["depth"] for q in samples) if samples else None
+        entry["queue_depth_workers"] = len({q["pid"] for q in samples})
+        timeline.append(entry)
+    return {
+        "config": {k: v for k, v in vars(args).items()},
+        "overall": dict(summarize(records, wall), dropped=dropped),
+        "by_image": {key: summarize([r for r in records if r["key"] == key], wall)
+                     for key in sorted({r["key"] for r in records})},
+        "timeline": timeline,
+        "queue_depth": queue_samples,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="target an already running server instead of starting gunicorn")
+    parser.add_argument("--workers", type=int, default=1, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads per worker")
+    parser.add_argument("--omp-threads", type=int,
+                        help="OMP_NUM_THREADS and SESSION_THREADS for the started server (above 1 implies --no-preload)")
+    parser.add_argument("--gunicorn-config", help="gunicorn config file (default: ./gunicorn.conf.py)")
+    parser.add_argument("--no-preload", action="store_true", help="load the model in each worker, not pre-fork")
+    parser.add_argument("--arrival", choices=("poisson", "burst"), default="poisson")
+    parser.add_argument("--rate", type=float, default=4.0, help="mean requests per second")
+    parser.add_argument("--burst-size", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of arrivals")
+    parser.add_argument("--concurrency", type=int, default=16, help="max in-flight requests")
+    parser.add_argument("--mix", default="jpeg:800:3,jpeg:3200:1,png:1600:1",
+                        help="format:size:weight entries, comma-separated")
+    parser.add_argument("--param", action="append", default=[], help="extra form field, e.g. model=u2net")
+    parser.add_argument("--window", type=float, default=5.0, help="timeline window in seconds")
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="queue depth sampling period")
+    parser.add_argument("--request-timeout", type=float, default=180.0)
+    parser.add_argument("--ready-timeout", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    result = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(result + "\n")
+    else:
+        print(result)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,119 @@
+"""Build INT8 model variants and measure their accuracy against float32.
+
+    python quantize.py build u2netp u2net
+    python quantize.py iou u2netp --samples ./samples --output iou.json
+
+`build` runs ONNX Runtime dynamic quantization on each model and writes
+<model>-int8.onnx into REMBG_HOME/quantized, where the server picks it up for
+precision=int8. `iou` predicts masks with both variants on a directory of
+sample images (or synthetic images when none is given) and reports mask IoU,
+mean absolute alpha difference and the inference speedup.
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import sys
+import time
+
+# The server's import-time preload is not needed here
+os.environ.setdefault("REMBG_DEFER_PRELOAD", "1")
+
+import server
+
+def build(model_name: str, per_channel: bool) -> str:
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    source = server._model_path(model_name)
+    target = server._quantized_model_path(model_name)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = f"{target}.{os.getpid()}.tmp"
+    start = time.monotonic()
+    quantize_dynamic(source, tmp, weight_type=QuantType.QUInt8, per_channel=per_channel)
+    os.replace(tmp, target)
+    print(f"{model_name}: {os.path.getsize(source) / 1e6:.1f} MB -> {os.path.getsize(target) / 1e6:.1f} MB "
+          f"in {time.monotonic() - start:.1f}s ({target})", file=sys.stderr)
+    return target
+
+def load_samples(samples_dir, count: int):
+    from PIL import Image
+    from bench import make_image
+
+    if samples_dir:
+        paths = sorted(p for ext in ("jpg", "jpeg", "png", "webp")
+                       for p in glob.glob(os.path.join(samples_dir, f"*.{ext}")))[:count]
+        if not paths:
+            raise SystemExit(f"No images found in {samples_dir}")
+        images = [(os.path.basename(p), Image.open(p)) for p in paths]
+    else:
+        print("No --samples given, using synthetic images (use real photos for a decision)", file=sys.stderr)
+        images = [(f"synthetic-{size}", Image.open(io.BytesIO(make_image(size, "PNG", i))))
+                  for i, size in enumerate((320, 640, 800, 1200)[:count])]
+    return [(name, server.downscale_if_needed(img, server.INFERENCE_DIM).convert("RGBA")) for name, img in images]
+
+def iou(model_name: str, samples_dir, count: int, threshold: int) -> dict:
+    import numpy as np
+
+    fp32 = server._create_session(server._model_key(model_name, "fp32"))
+    int8 = server._create_session(server._model_key(model_name, "int8"))
+    rows, times = [], {"fp32": 0.0, "int8": 0.0}
+    for name, img in load_samples(samples_dir, count):
+        masks = {}
+        for label, sess in (("fp32", fp32), ("int8", int8)):
+            start = time.perf_counter()
+            masks[label] = np.asarray(server._infer_masks(sess, [img])[0])
+            times[label] += time.perf_counter() - start
+        a, b = masks["fp32"] >= threshold, masks["int8"] >= threshold
+        union = np.logical_or(a, b).sum()
+        rows.append({
+            "image": name,
+            "iou": round(float(np.logical_and(a, b).sum() / union) if union else 1.0, 4),
+            "mean_abs_alpha_diff": round(float(np.abs(masks["fp32"].astype(np.int16) - masks["int8"]).mean()), 3),
+        })
+    ious = [r["iou"] for r in rows]
+    return {
+        "model": model_name,
+        "threshold": threshold,
+        "images": rows,
+        "mean_iou": round(sum(ious) / len(ious), 4),
+        "min_iou": min(ious),
+        "fp32_seconds": round(times["fp32"], 3),
+        "int8_seconds": round(times["int8"], 3),
+        "speedup": round(times["fp32"] / times["int8"], 2) if times["int8"] else None,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    build_p = sub.add_parser("build", help="write INT8 variants into REMBG_HOME/quantized")
+    build_p.add_argument("models", nargs="*", default=[server.DEFAULT_MODEL])
+    build_p.add_argument("--per-channel", action="store_true", help="per-channel weight scales")
+
+    iou_p = sub.add_parser("iou", help="compare INT8 masks against float32")
+    iou_p.add_argument("models", nargs="*", default=[server.DEFAULT_MODEL])
+    iou_p.add_argument("--samples", help="directory of sample images")
+    iou_p.add_argument("--count", type=int, default=50, help="max sample images")
+    iou_p.add_argument("--threshold", type=int, default=128, help="alpha threshold for binarizing masks")
+    iou_p.add_argument("--output", help="write JSON here instead of stdout")
+
+    args = parser.parse_args(argv)
+    for model in args.models:
+        if model not in server.MODEL_INPUTS:
+            raise SystemExit(f"Unknown model: {model}")
+    if args.command == "build":
+        for model in args.models:
+            build(model, args.per_channel)
+        return 0
+
+    report = json.dumps([iou(model, args.samples, args.count, args.threshold) for model in args.models], indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,29 @@
+import hashlib
 import io
+import json
 import os
+import queue
 import tempfile
-from flask import Flask, request, send_file, jsonify
+import time
+import uuid
+import weakref
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from flask import Flask, Request, g, request, send_file, jsonify
+from werkzeug.exceptions import HTTPException
+from werkzeug.formparser import FormDataParser, MultiPartParser
 from PIL import Image, ImageFile
+import numpy as np
 import threading
+from collections import OrderedDict
 # Lazy import rembg to speed up startup and allow immediate port binding
 remove_fn = None
-session = None
 ready_event = threading.Event()
 preload_error = None
+# Startup phase durations in seconds, reported on /ready
+startup_phases = {}
+_process_start = time.monotonic()
 
 app = Flask(__name__)
 
@@ -28,11 +43,159 @@ app.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024
 # Allow loading truncated images
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
+# Micro-batching: concurrent requests are collected for up to BATCH_MAX_WAIT_MS
+# and run as a single batched inference over the shared session
+BATCH_MAX_SIZE = max(1, int(os.environ.get("BATCH_MAX_SIZE", "8")))
+BATCH_MAX_WAIT_MS = max(0.0, float(os.environ.get("BATCH_MAX_WAIT_MS", "10")))
+
+# Result cache: in-memory LRU bounded by total bytes, plus an optional on-disk tier
+RESULT_CACHE_MAX_BYTES = int(float(os.environ.get("RESULT_CACHE_MAX_MB", "64")) * 1024 * 1024)
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR") or None
+
+# Session pool: one ONNX session per inference worker, each with its own intra-op threads.
+# Requests waiting longer than SESSION_WAIT_TIMEOUT seconds for a session get a 503.
+SESSION_POOL_SIZE = max(1, int(os.environ.get("SESSION_POOL_SIZE", "1")))
+SESSION_THREADS = max(1, int(os.environ.get("SESSION_THREADS") or os.environ["OMP_NUM_THREADS"]))
+SESSION_WAIT_TIMEOUT = float(os.environ.get("SESSION_WAIT_TIMEOUT", "30"))
+
+# ONNX Runtime session tuning. SESSION_THREADS is the intra-op thread count; inter-op
+# threads only matter with ORT_EXECUTION_MODE=parallel. The optimized graph is saved
+# under REMBG_HOME/optimized and loaded directly on later starts, skipping optimization.
+ORT_INTER_OP_THREADS = max(1, int(os.environ.get("ORT_INTER_OP_THREADS", "1")))
+ORT_GRAPH_OPT_LEVEL = os.environ.get("ORT_GRAPH_OPT_LEVEL", "all")
+# 'all' adds layout transformations (NCHWc) specific to the CPU that runs them, and the
+# saved graph may be built on another host (render.yaml's buildCommand), so graphs are
+# saved at 'extended' at most and the remaining level is applied when they are loaded
+SAVED_GRAPH_OPT_LEVEL = "extended" if ORT_GRAPH_OPT_LEVEL == "all" else ORT_GRAPH_OPT_LEVEL
+ORT_EXECUTION_MODE = os.environ.get("ORT_EXECUTION_MODE", "sequential")
+ORT_ENABLE_MEM_ARENA = os.environ.get("ORT_ENABLE_MEM_ARENA", "1") != "0"
+ORT_ENABLE_MEM_PATTERN = os.environ.get("ORT_ENABLE_MEM_PATTERN", "1") != "0"
+ORT_SAVE_OPTIMIZED = os.environ.get("ORT_SAVE_OPTIMIZED", "1") != "0"
+OPTIMIZED_MODEL_DIR = os.path.join(cache_dir, "optimized")
+
+# INT8 variants built by `python quantize.py build` live under REMBG_HOME/quantized and
+# are selected with precision=int8 per request or REMBG_PRECISION globally
+QUANTIZED_MODEL_DIR = os.path.join(cache_dir, "quantized")
+QUANTIZED_SUFFIX = "-int8"
+PRECISIONS = ("fp32", "int8")
+REMBG_PRECISION = os.environ.get("REMBG_PRECISION", "fp32")
+
+# Inference engine: "native" feeds the ONNX session directly and composites in NumPy;
+# "rembg" calls rembg.remove(). The native engine falls back to rembg on failure.
+REMBG_ENGINE = os.environ.get("REMBG_ENGINE", "native")
+
+# Output encoding defaults; PNG favors speed over size (zlib level 1, no optimize pass)
+PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", "1"))
+WEBP_QUALITY = int(os.environ.get("WEBP_QUALITY", "80"))
+WEBP_METHOD = int(os.environ.get("WEBP_METHOD", "2"))
+OUTPUT_MIMETYPES = {"png": "image/png", "webp": "image/webp"}
+
+# Async jobs: JOB_WORKERS threads drain a queue of at most JOB_QUEUE_SIZE pending jobs;
+# finished results are kept for JOB_TTL seconds, oldest first out once they hold more
+# than JOB_RESULTS_MAX_MB between them
+JOB_WORKERS = max(1, int(os.environ.get("JOB_WORKERS", "2")))
+JOB_QUEUE_SIZE = max(1, int(os.environ.get("JOB_QUEUE_SIZE", "32")))
+JOB_TTL = float(os.environ.get("JOB_TTL", "600"))
+JOB_RESULTS_MAX_BYTES = int(float(os.environ.get("JOB_RESULTS_MAX_MB", "256")) * 1024 * 1024)
+
+# Batch endpoint: at most BATCH_MAX_IMAGES images per request; zip uploads may expand
+# to at most BATCH_MAX_UNZIPPED_MB in total
+BATCH_MAX_IMAGES = max(1, int(os.environ.get("BATCH_MAX_IMAGES", "50")))
+BATCH_MAX_UNZIPPED_BYTES = int(float(os.environ.get("BATCH_MAX_UNZIPPED_MB", "40")) * 1024 * 1024)
+
+# Streaming uploads: the image header is sniffed while the body arrives so unsupported
+# formats and oversized dimensions are rejected before the upload finishes
+UPLOAD_FORMATS = {"JPEG", "PNG", "WEBP", "BMP", "GIF", "TIFF", "MPO"}
+UPLOAD_MAX_SIDE = int(os.environ.get("UPLOAD_MAX_SIDE", "12000"))
+UPLOAD_SNIFF_LIMIT = 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Decompression-bomb guard, checked against header dimensions before any pixels are
+# allocated: each request may decode at most MAX_MEGAPIXELS (JPEGs count at their
+# draft-decoded size, and larger ones are drafted down to fit) and all in-flight
+# requests of a worker process share CONCURRENT_MEGAPIXELS, waiting
+# up to PIXEL_WAIT_TIMEOUT seconds for room before getting a 503. A request holds its
+# share from decode until encoding finishes, charged for the decoded pixels plus
+# WORKING_PIXELS_PER_OUTPUT_PIXEL for each output pixel: the RGBA copy, the mask and
+# the RGBA result take about three decoded RGB pixels' worth of memory between them
+MAX_PIXELS = int(float(os.environ.get("MAX_MEGAPIXELS", "40")) * 1e6)
+CONCURRENT_PIXELS = int(float(os.environ.get("CONCURRENT_MEGAPIXELS", "120")) * 1e6)
+PIXEL_WAIT_TIMEOUT = float(os.environ.get("PIXEL_WAIT_TIMEOUT", "10"))
+WORKING_PIXELS_PER_OUTPUT_PIXEL = 3
+# Pillow's own bomb check as a backstop for anything that bypasses the guard
+Image.MAX_IMAGE_PIXELS = UPLOAD_MAX_SIDE * UPLOAD_MAX_SIDE
+
+DEFAULT_MODEL = "u2netp"
+# Results keep the upload's resolution unless MAX_OUTPUT_DIM (or the max_dim parameter)
+# caps the long side; 0 means no cap. JPEGs above MAX_MEGAPIXELS come back at the
+# 1/2, 1/4 or 1/8 scale they were decoded at. The model only sees a copy downscaled to
+# INFERENCE_DIM (or its own input size, if larger) and its mask is upsampled back.
+MAX_DIM = int(os.environ.get("MAX_OUTPUT_DIM", "0"))
+INFERENCE_DIM = int(os.environ.get("INFERENCE_DIM", "800"))
+# refine=1 re-predicts up to REFINE_MAX_TILES tiles of 1/REFINE_ZOOM of the long side
+# that contain the most uncertain mask pixels (alpha strictly inside REFINE_BAND)
+REFINE_ZOOM = int(os.environ.get("REFINE_ZOOM", "4"))
+REFINE_MAX_TILES = int(os.environ.get("REFINE_MAX_TILES", "8"))
+REFINE_BAND = (16, 240)
+# alpha_matting=1 solves soft edges with a guided filter on the trimap's unknown band.
+# Pixels at or above/below the thresholds are definite foreground/background; the band
+# is widened by MATTING_ERODE and filtered with MATTING_RADIUS, both in inference-copy
+# pixels. The filter is solved on the inference copy, subsampled when needed, and
+# applied to full-resolution band tiles while they fit in MATTING_BUDGET_MS.
+MATTING_FG_THRESHOLD = int(os.environ.get("MATTING_FG_THRESHOLD", "240"))
+MATTING_BG_THRESHOLD = int(os.environ.get("MATTING_BG_THRESHOLD", "10"))
+MATTING_ERODE = int(os.environ.get("MATTING_ERODE", "10"))
+MATTING_RADIUS = int(os.environ.get("MATTING_RADIUS", "8"))
+MATTING_EPS = float(os.environ.get("MATTING_EPS", "1e-3"))
+MATTING_BUDGET_MS = int(os.environ.get("MATTING_BUDGET_MS", "50"))
+# Side of the tiles the solved filter is applied on, in inference-copy pixels
+MATTING_TILE = 16
+# crop=subject trims to pixels with at least this alpha; fainter ones are model noise
+CROP_MIN_ALPHA = 8
+
+# Model registry: non-default models load lazily on first use and are evicted LRU-first
+# once the estimated resident size of loaded models exceeds MODEL_MEMORY_MB.
+# Requests wait up to MODEL_LOAD_WAIT seconds for a lazy load before getting a 503.
+MODEL_MEMORY_BYTES = int(float(os.environ.get("MODEL_MEMORY_MB", "600")) * 1024 * 1024)
+MODEL_LOAD_WAIT = float(os.environ.get("MODEL_LOAD_WAIT", "20"))
+
+# Model input size and normalization (mean, std), mirroring rembg's session classes
+MODEL_INPUTS = {
+    "u2netp": ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    "u2net": ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    "u2net_human_seg": ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    "silueta": ((320, 320), (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)),
+    "isnet-general-use": ((1024, 1024), (0.5, 0.5, 0.5), (1.0, 1.0, 1.0)),
+    "isnet-anime": ((1024, 1024), (0.485, 0.456, 0.406), (1.0, 1.0, 1.0)),
+}
+
+# Models selectable per request; REMBG_MODELS narrows the list (comma-separated)
+AVAILABLE_MODELS = [
+    m for m in (x.strip() for x in os.environ.get("REMBG_MODELS", ",".join(MODEL_INPUTS)).split(","))
+    if m in MODEL_INPUTS
+]
+if DEFAULT_MODEL not in AVAILABLE_MODELS:
+    AVAILABLE_MODELS.insert(0, DEFAULT_MODEL)
+
+def _model_key(model: str, precision: str = "fp32") -> str:
+    """Registry key of a model at the given precision, e.g. 'u2netp-int8'."""
+    return model + QUANTIZED_SUFFIX if precision == "int8" else model
+
+def _split_model_key(key: str):
+    """Inverse of _model_key: ('u2netp-int8') -> ('u2netp', 'int8')."""
+    if key.endswith(QUANTIZED_SUFFIX):
+        return key[:-len(QUANTIZED_SUFFIX)], "int8"
+    return key, "fp32"
+
 # Ensure plaintext errors for common failures
 @app.errorhandler(413)
 def handle_request_entity_too_large(e):
     return ("File too large", 413, {"Content-Type": "text/plain"})
 
+@app.errorhandler(415)
+def handle_unsupported_media_type(e):
+    return ("Unsupported Media Type", 415, {"Content-Type": "text/plain"})
+
 @app.errorhandler(405)
 def handle_method_not_allowed(e):
     return ("Method Not Allowed", 405, {"Content-Type": "text/plain"})
@@ -41,90 +204,1859 @@ def handle_method_not_allowed(e):
 def handle_internal_error(e):
     return (f"Internal Server Error: {e}", 500, {"Content-Type": "text/plain"})
 
+class Counter:
+    """Monotonic counter with optional labels, rendered in Prometheus text format."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, dict(key), value) for key, value in self._values.items()]
+
+class Gauge:
+    """Gauge whose value is read from a callback at scrape time."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, read):
+        self.name = name
+        self.help_text = help_text
+        self._read = read
+        METRICS.append(self)
+
+    def samples(self):
+        return [(self.name, {}, self._read())]
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, (counts, total, count) in self._series.items():
+                labels = dict(key)
+                for bound, n in zip(self.buckets, counts):
+                    out.append((f"{self.name}_bucket", dict(labels, le=f"{bound:g}"), n))
+                out.append((f"{self.name}_bucket", dict(labels, le="+Inf"), count))
+                out.append((f"{self.name}_sum", labels, total))
+                out.append((f"{self.name}_count", labels, count))
+        return out
+
+METRICS = []
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{name}{{{label_str}}} {value:.12g}" if label_str else f"{name} {value:.12g}")
+    return "\n".join(lines) + "\n"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGE_SECONDS = Histogram("removebg_stage_seconds", "Time spent per pipeline stage.", LATENCY_BUCKETS)
+BATCH_SIZE = Histogram("removebg_batch_size", "Images per batched inference run.", (1, 2, 4, 8, 16, 32))
+INPUT_MEGAPIXELS = Histogram("removebg_input_megapixels", "Input image size in megapixels.",
+                             (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 40))
+INPUT_MEGAPIXELS_TOTAL = Counter("removebg_input_megapixels_total", "Total input megapixels processed.")
+CACHE_REQUESTS = Counter("removebg_cache_requests_total", "Result cache lookups by result.")
+NOT_READY = Counter("removebg_not_ready_total", "Requests rejected with 503 before the model was ready.")
+ERRORS = Counter("removebg_errors_total", "Pipeline errors by HTTP status.")
+RESPONSES = Counter("removebg_http_responses_total", "HTTP responses by endpoint and status.")
+
+class StageTimer:
+    """Records per-stage durations for one request and feeds the stage histogram."""
+
+    def __init__(self):
+        self.durations = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.durations[name] = self.durations.get(name, 0.0) + elapsed
+            STAGE_SECONDS.observe(elapsed, stage=name)
+
+    def server_timing(self, **descriptions) -> str:
+        """Format recorded stages (in ms) and descriptive entries as a Server-Timing header."""
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.durations.items()]
+        entries += [f'{name};desc="{value}"' for name, value in descriptions.items()]
+        return ", ".join(entries)
+
+class RequestError(Exception):
+    """An error reported to clients as plain text with an HTTP status."""
+
+    status = 500
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        if status is not None:
+            self.status = status
+
+class PoolTimeout(RequestError):
+    """Raised when no session becomes available before the wait deadline."""
+
+    status = 503
+
+class ModelLoading(RequestError):
+    """Raised when a lazily loaded model is not ready within the wait deadline."""
+
+    status = 503
+
+class ModelUnloaded(Exception):
+    """Raised when submitting to a model runtime that has been evicted."""
+
+# Objects that own worker threads. Threads do not survive fork(), so when gunicorn
+# forks a preloaded master each of these restarts its workers in the child.
+_fork_hooks = weakref.WeakSet()
+
+def _after_fork_in_child():
+    for obj in list(_fork_hooks):
+        obj._after_fork()
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+class SessionPool:
+    """Fixed set of inference sessions handed out with acquire()/release()."""
+
+    def __init__(self, factory, size: int = SESSION_POOL_SIZE):
+        self.size = size
+        self._idle = queue.Queue()
+        # The first session may have to optimize and save the graph; the rest load in parallel
+        self._idle.put(factory())
+        if size > 1:
+            with ThreadPoolExecutor(max_workers=size - 1) as pool:
+                for sess in pool.map(lambda _: factory(), range(size - 1)):
+                    self._idle.put(sess)
+
+    def acquire(self, timeout: float = SESSION_WAIT_TIMEOUT):
+        try:
+            return self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise PoolTimeout(f"No inference session available within {timeout:g}s")
+
+    def release(self, sess):
+        self._idle.put(sess)
+
+    @contextmanager
+    def checkout(self, timeout: float = SESSION_WAIT_TIMEOUT):
+        sess = self.acquire(timeout)
+        try:
+            yield sess
+        finally:
+            self.release(sess)
+
+class OrtSession:
+    """An ONNX Runtime session for one model.
+
+    The native engine uses inner_session directly. The rembg engine (and the
+    native engine's fallback) runs rembg's own session class, built on first
+    use around the same inner_session; see _rembg_session.
+    """
+
+    def __init__(self, model_name: str, inner_session, model_path: str):
+        self.model_name = model_name
+        self.inner_session = inner_session
+        self.model_path = model_path
+        self.rembg_session = None
+
+def _rembg_session(sess: OrtSession):
+    """rembg's session object for the model, sharing the already loaded ONNX Runtime session.
+
+    rembg.remove() then runs rembg's own preprocessing, prediction and mask
+    postprocessing, independent of the native engine's code.
+    """
+    if sess.rembg_session is None:
+        from rembg.sessions import sessions_class
+        session_class = next(sc for sc in sessions_class if sc.name() == sess.model_name)
+        # Skip __init__, which would load a second copy of the model
+        rembg_session = session_class.__new__(session_class)
+        rembg_session.model_name = sess.model_name
+        rembg_session.inner_session = sess.inner_session
+        sess.rembg_session = rembg_session
+    return sess.rembg_session
+
+def _model_path(model_name: str) -> str:
+    """Path of the model's ONNX file, downloaded into the rembg model home if missing."""
+    # Same location rembg uses; checking it first avoids importing rembg on the startup path
+    u2net_home = os.path.expanduser(os.getenv("U2NET_HOME", os.path.join(os.getenv("XDG_DATA_HOME", "~"), ".u2net")))
+    path = os.path.join(u2net_home, f"{model_name}.onnx")
+    if os.path.exists(path):
+        return path
+    from rembg.sessions import sessions_class
+    session_class = next((sc for sc in sessions_class if sc.name() == model_name), None)
+    if session_class is None:
+        raise ValueError(f"Unknown model: {model_name}")
+    return session_class.download_models()
+
+def _graph_opt_level(name: str):
+    import onnxruntime as ort
+    levels = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+    if name not in levels:
+        raise ValueError(f"Invalid ORT_GRAPH_OPT_LEVEL '{name}', expected one of: {', '.join(levels)}")
+    return levels[name]
+
+def _session_options(threads: int):
+    import onnxruntime as ort
+    sess_opts = ort.SessionOptions()
+    sess_opts.intra_op_num_threads = threads
+    sess_opts.inter_op_num_threads = ORT_INTER_OP_THREADS
+    sess_opts.graph_optimization_level = _graph_opt_level(ORT_GRAPH_OPT_LEVEL)
+    sess_opts.execution_mode = (ort.ExecutionMode.ORT_PARALLEL if ORT_EXECUTION_MODE == "parallel"
+                                else ort.ExecutionMode.ORT_SEQUENTIAL)
+    sess_opts.enable_cpu_mem_arena = ORT_ENABLE_MEM_ARENA
+    sess_opts.enable_mem_pattern = ORT_ENABLE_MEM_PATTERN
+    return sess_opts
+
+def _quantized_model_path(model_name: str) -> str:
+    return os.path.join(QUANTIZED_MODEL_DIR, f"{model_name}{QUANTIZED_SUFFIX}.onnx")
+
+def _optimized_model_path(model_key: str) -> str:
+    import onnxruntime as ort
+    # Optimized graphs can contain level- and version-specific fused ops, so key on both
+    return os.path.join(OPTIMIZED_MODEL_DIR, f"{model_key}.{SAVED_GRAPH_OPT_LEVEL}.ort-{ort.__version__}.onnx")
+
+def _source_model_path(model_key: str) -> str:
+    model_name, precision = _split_model_key(model_key)
+    if precision == "fp32":
+        return _model_path(model_name)
+    path = _quantized_model_path(model_name)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"No INT8 model for '{model_name}', run `python quantize.py build {model_name}`")
+    return path
+
+def _create_session(model_key: str, threads: int = SESSION_THREADS) -> OrtSession:
+    """Build a session with the configured ONNX Runtime settings.
+
+    The first load optimizes the graph up to SAVED_GRAPH_OPT_LEVEL and saves
+    it; later loads read the saved graph and only apply what is left of
+    ORT_GRAPH_OPT_LEVEL (the hardware-specific 'all' transformations), with
+    optimization otherwise turned off.
+    """
+    import onnxruntime as ort
+    sess_opts = _session_options(threads)
+    optimized = _optimized_model_path(model_key)
+    tmp = None
+    if ORT_SAVE_OPTIMIZED and ORT_GRAPH_OPT_LEVEL != "disable" and os.path.exists(optimized):
+        path = optimized
+        if SAVED_GRAPH_OPT_LEVEL == ORT_GRAPH_OPT_LEVEL:
+            sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+    else:
+        path = _source_model_path(model_key)
+        if ORT_SAVE_OPTIMIZED and ORT_GRAPH_OPT_LEVEL != "disable":
+            # Save under a temporary name so other processes never load a partial file
+            os.makedirs(OPTIMIZED_MODEL_DIR, exist_ok=True)
+            tmp = f"{optimized}.{os.getpid()}.{threading.get_ident()}.tmp"
+            sess_opts.optimized_model_filepath = tmp
+            sess_opts.graph_optimization_level = _graph_opt_level(SAVED_GRAPH_OPT_LEVEL)
+    inner = ort.InferenceSession(path, sess_options=sess_opts, providers=["CPUExecutionProvider"])
+    if tmp is not None and os.path.exists(tmp):
+        os.replace(tmp, optimized)
+        print(f"Saved optimized model graph: {optimized}")
+        if SAVED_GRAPH_OPT_LEVEL != ORT_GRAPH_OPT_LEVEL:
+            # This session stopped at the saved level; reload to get the full configured level
+            return _create_session(model_key, threads)
+    return OrtSession(_split_model_key(model_key)[0], inner, path)
+
+def _session_bytes(sess: OrtSession) -> int:
+    """Approximate resident size of a session from its model file on disk."""
+    try:
+        return os.path.getsize(sess.model_path)
+    except OSError:
+        return 0
+
+@contextmanager
+def _startup_phase(name: str):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        startup_phases[name] = round(time.monotonic() - start, 3)
+
+def _import_rembg():
+    global remove_fn
+    try:
+        with _startup_phase("import_rembg"):
+            from rembg import remove as _remove
+        remove_fn = _remove
+    except Exception as e:
+        print(f"rembg import failed (native engine only): {e}")
+
 # Preload rembg in a background thread so the first request is faster
-def _preload_rembg():
-    global remove_fn, session, preload_error
+def _preload_rembg(import_rembg: bool = True):
+    global preload_error
     try:
-        from rembg import remove as _remove, new_session as _new_session
         print("Starting rembg preload...")
         print(f"Model cache directory: {os.environ.get('REMBG_HOME')}")
-        remove_fn = _remove
+        # rembg (and its heavy dependencies) is only needed by the rembg engine, so import
+        # it alongside the model load instead of in front of it
+        rembg_thread = None
+        if import_rembg:
+            rembg_thread = threading.Thread(target=_import_rembg, daemon=True)
+            rembg_thread.start()
+        with _startup_phase("import_onnxruntime"):
+            import onnxruntime  # noqa: F401
         # Use a lighter/faster model to reduce processing time on free-tier CPU
-        session = _new_session("u2netp")
-        # Warm up the model to avoid first-request timeouts
-        try:
-            blank_img = Image.new("RGBA", (8, 8), (0, 0, 0, 0))
-            remove_fn(blank_img, session=session)
-            print("rembg warm-up completed.")
-        except Exception as warm_e:
-            print(f"rembg warm-up failed (continuing): {warm_e}")
-        finally:
-            ready_event.set()
+        # (loading also warms up every session to avoid first-request timeouts)
+        runtime = model_registry.load(_model_key(DEFAULT_MODEL, REMBG_PRECISION))
+        startup_phases.update(runtime.timings)
+        print(f"Session pool ready: {SESSION_POOL_SIZE} x {SESSION_THREADS} threads")
+        if rembg_thread is not None and REMBG_ENGINE == "rembg":
+            rembg_thread.join()
+            if remove_fn is None:
+                raise RuntimeError("REMBG_ENGINE=rembg but rembg could not be imported")
     except Exception as e:
         preload_error = str(e)
         print(f"rembg preload failed: {preload_error}")
+    finally:
+        startup_phases["time_to_ready"] = round(time.monotonic() - _process_start, 3)
+        print(f"Startup phases: {startup_phases}")
         # Ensure we don't block forever on readiness checks
         ready_event.set()
 
-threading.Thread(target=_preload_rembg, daemon=True).start()
+def preload_for_fork():
+    """Load the default model in a gunicorn master before it forks its workers.
+
+    Workers inherit the loaded sessions, so the model weights are shared
+    copy-on-write instead of being loaded once per worker. ONNX Runtime thread
+    pools do not survive fork(), so shared sessions must run inference on the
+    calling thread: SESSION_THREADS=1 and sequential execution.
+    """
+    if SESSION_THREADS != 1 or ORT_EXECUTION_MODE == "parallel":
+        raise RuntimeError("Pre-fork model loading needs SESSION_THREADS=1 and ORT_EXECUTION_MODE=sequential")
+    # rembg is imported by each worker in import_rembg_after_fork(), so the master neither
+    # spends startup time on it nor forks while a thread is mid-import
+    _preload_rembg(import_rembg=False)
+
+def import_rembg_after_fork():
+    """Import rembg in a gunicorn worker forked from a master that skipped it.
+
+    The rembg engine needs it before the worker serves its first request; for
+    the native engine it is only a fallback and is imported in the background.
+    """
+    global preload_error
+    if REMBG_ENGINE != "rembg":
+        threading.Thread(target=_import_rembg, daemon=True).start()
+        return
+    _import_rembg()
+    if remove_fn is None and preload_error is None:
+        preload_error = "REMBG_ENGINE=rembg but rembg could not be imported"
+
+# Per-thread scratch buffers reused across batches by the native engine
+_buffers = threading.local()
+
+def _scratch(name: str, shape, dtype) -> np.ndarray:
+    """Return a thread-local buffer of at least `shape`, reallocating only when it grows."""
+    buf = getattr(_buffers, name, None)
+    if buf is None or buf.dtype != dtype or buf.size < int(np.prod(shape)):
+        buf = np.empty(shape, dtype=dtype)
+        setattr(_buffers, name, buf)
+    return buf.reshape(-1)[:int(np.prod(shape))].reshape(shape)
+
+def _preprocess_into(out: np.ndarray, img: Image.Image, model_name: str):
+    """Resize and normalize an image into a preallocated (3, H, W) float32 slot."""
+    size, mean, std = MODEL_INPUTS[model_name]
+    rgb = np.asarray(img.convert("RGB").resize(size, Image.LANCZOS))
+    # Same arithmetic as rembg: (x / max - mean) / std, folded into one scale and offset
+    scale = 1.0 / max(int(rgb.max()), 1)
+    for c in range(3):
+        np.multiply(rgb[:, :, c], np.float32(scale / std[c]), out=out[c], dtype=np.float32)
+        out[c] -= mean[c] / std[c]
+
+def _postprocess(pred: np.ndarray, size) -> Image.Image:
+    """Min-max normalize a raw (H, W) prediction into an 8-bit mask of the given size."""
+    lo, hi = float(pred.min()), float(pred.max())
+    pred = (pred - lo) / max(hi - lo, 1e-6)
+    mask = Image.fromarray((pred * 255).astype(np.uint8), mode="L")
+    return mask.resize(size, Image.LANCZOS)
+
+def _infer_masks(sess, images):
+    """Run one inference over a list of images and return their masks."""
+    inner = sess.inner_session
+    model_input = inner.get_inputs()[0]
+    (h, w), _, _ = MODEL_INPUTS[sess.model_name]
+    tensors = _scratch("input", (len(images), 3, h, w), np.float32)
+    for slot, img in zip(tensors, images):
+        _preprocess_into(slot, img, sess.model_name)
+    # Models exported with a fixed batch dimension of 1 are run item by item
+    if isinstance(model_input.shape[0], int) and model_input.shape[0] == 1:
+        preds = [inner.run(None, {model_input.name: tensors[i:i + 1]})[0][0, 0] for i in range(len(images))]
+    else:
+        preds = inner.run(None, {model_input.name: tensors})[0][:, 0]
+    return [_postprocess(pred, img.size) for pred, img in zip(preds, images)]
+
+def _upsample_mask(mask: Image.Image, size) -> Image.Image:
+    """Scale a mask predicted on the inference copy up to the output size."""
+    if mask.size == size:
+        return mask
+    return mask.resize(size, Image.BILINEAR)
+
+def _composite(img: Image.Image, mask: Image.Image) -> Image.Image:
+    """Cut out the subject in NumPy, matching rembg's naive cutout.
+
+    Every RGBA channel is scaled by mask / 255 with rounding, which is what
+    Image.composite(img, transparent, mask) does, without building the
+    intermediate transparent image. Rows are processed in blocks so the
+    16-bit scratch buffer stays small for full-resolution images.
+    """
+    rgba = np.asarray(img.convert("RGBA"))
+    alpha = np.asarray(mask)
+    h, w = rgba.shape[:2]
+    out = np.empty((h, w, 4), dtype=np.uint8)
+    rows = max(1, min(h, (1 << 20) // w))
+    acc = _scratch("composite", (rows, w, 4), np.uint16)
+    for top in range(0, h, rows):
+        n = min(rows, h - top)
+        block = acc[:n]
+        np.multiply(rgba[top:top + n], alpha[top:top + n, :, None], out=block, dtype=np.uint16)
+        block += 127
+        block //= 255
+        out[top:top + n] = block
+    return Image.fromarray(out, mode="RGBA")
+
+class MaskBatcher:
+    """Collects concurrent mask requests and runs them as one batched inference.
+
+    Callers get a Future from submit(); one worker thread per pooled session
+    drains the queue, waiting at most max_wait_ms after the first item for up
+    to max_batch_size items before checking out a session and running it once
+    for the whole batch. Items that waited longer than SESSION_WAIT_TIMEOUT
+    fail with PoolTimeout instead of being run.
+    """
+
+    def __init__(self, get_pool, workers: int = SESSION_POOL_SIZE,
+                 max_batch_size: int = BATCH_MAX_SIZE, max_wait_ms: float = BATCH_MAX_WAIT_MS):
+        self._get_pool = get_pool
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._workers = workers
+        self._closed = False
+        self._start_workers()
+        _fork_hooks.add(self)
+
+    def _start_workers(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._run, daemon=True) for _ in range(self._workers)]
+        for t in self._threads:
+            t.start()
+
+    def _after_fork(self):
+        # The queue is replaced too: its condition variables still list the parent's waiting workers
+        if not self._closed:
+            self._start_workers()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def submit(self, img: Image.Image) -> Future:
+        fut = Future()
+        with self._lock:
+            if self._closed:
+                raise ModelUnloaded("Model was unloaded")
+            self._queue.put((img, fut, time.monotonic() + SESSION_WAIT_TIMEOUT))
+        return fut
+
+    def close(self):
+        """Stop the workers once everything already queued has been processed."""
+        with self._lock:
+            self._closed = True
+            for _ in self._threads:
+                self._queue.put(None)
+
+    def _collect(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Leave the stop marker for the next loop iteration
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            if items is None:
+                return
+            batch = []
+            now = time.monotonic()
+            for img, fut, deadline in items:
+                # Callers cancel items they stopped waiting for; the rest can no longer be cancelled
+                if not fut.set_running_or_notify_cancel():
+                    continue
+                if now > deadline:
+                    fut.set_exception(PoolTimeout("Timed out waiting for an inference session"))
+                else:
+                    batch.append((img, fut))
+            if not batch:
+                continue
+            try:
+                with self._get_pool().checkout() as sess:
+                    BATCH_SIZE.observe(len(batch))
+                    masks = _infer_masks(sess, [img for img, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    fut.set_exception(e)
+                continue
+            for (_, fut), mask in zip(batch, masks):
+                fut.set_result(mask)
+
+class ModelRuntime:
+    """A loaded model: its session pool and the batcher feeding it."""
+
+    def __init__(self, name: str, pool_size: int = SESSION_POOL_SIZE):
+        self.name = name
+        start = time.monotonic()
+        self.pool = SessionPool(lambda: _create_session(name), pool_size)
+        self.timings = {"load_model": round(time.monotonic() - start, 3)}
+        self.batcher = MaskBatcher(lambda: self.pool, pool_size)
+        with self.pool.checkout() as sess:
+            self.resident_bytes = _session_bytes(sess) * pool_size
+
+    def warm_up(self):
+        start = time.monotonic()
+        blank_img = Image.new("RGBA", (8, 8), (0, 0, 0, 0))
+        held = [self.pool.acquire() for _ in range(self.pool.size)]
+        try:
+            for sess in held:
+                _infer_masks(sess, [blank_img])
+            self.timings["warm_up"] = round(time.monotonic() - start, 3)
+        finally:
+            for sess in held:
+                self.pool.release(sess)
+
+    def close(self):
+        self.batcher.close()
+
+class ModelRegistry:
+    """Lazily loads model runtimes and keeps them within a resident memory budget.
+
+    The default model is pinned; other models load in a background thread on
+    first use and the least recently used ones are unloaded when the estimated
+    resident size exceeds max_bytes.
+    """
+
+    def __init__(self, names, max_bytes: int = MODEL_MEMORY_BYTES, pinned=(DEFAULT_MODEL,)):
+        self.max_bytes = max_bytes
+        self.pinned = set(pinned)
+        self._lock = threading.Lock()
+        self._runtimes = OrderedDict()
+        self._state = {name: {"state": "unloaded", "error": None} for name in names}
+        self._loaded_events = {}
+
+    def load(self, name: str) -> ModelRuntime:
+        """Load a model synchronously (no-op if it is already loaded)."""
+        with self._lock:
+            runtime = self._runtimes.get(name)
+            if runtime is not None:
+                return runtime
+            self._state[name] = {"state": "loading", "error": None}
+        try:
+            runtime = ModelRuntime(name)
+        except Exception as e:
+            with self._lock:
+                self._state[name] = {"state": "error", "error": str(e)}
+            raise
+        try:
+            runtime.warm_up()
+            print(f"Warm-up completed: {name}")
+        except Exception as warm_e:
+            print(f"Warm-up failed for {name} (continuing): {warm_e}")
+        with self._lock:
+            self._runtimes[name] = runtime
+            self._state[name] = {"state": "ready", "error": None}
+            self._evict_locked(keep=name)
+        print(f"Model loaded: {name} ({runtime.resident_bytes / 1e6:.1f} MB)")
+        return runtime
+
+    def get(self, name: str, wait: float = MODEL_LOAD_WAIT) -> ModelRuntime:
+        """Return a ready runtime, starting a lazy load and waiting up to `wait` seconds."""
+        if name not in self._state:
+            raise ValueError(f"Unknown model: {name}")
+        with self._lock:
+            runtime = self._runtimes.get(name)
+            if runtime is not None:
+                self._runtimes.move_to_end(name)
+                return runtime
+            event = self._loaded_events.get(name)
+            if event is None:
+                event = self._loaded_events[name] = threading.Event()
+                threading.Thread(target=self._load_in_background, args=(name, event), daemon=True).start()
+        if not event.wait(wait):
+            raise ModelLoading(f"Model '{name}' is loading, please retry in a few seconds")
+        with self._lock:
+            runtime = self._runtimes.get(name)
+            if runtime is not None:
+                return runtime
+            state = self._state[name]
+        if state["state"] == "error":
+            raise RuntimeError(f"Model '{name}' failed to load: {state['error']}")
+        raise ModelLoading(f"Model '{name}' is loading, please retry in a few seconds")
+
+    def submit(self, name: str, img: Image.Image) -> Future:
+        """Queue an image on the model's batcher, reloading it if it was just evicted."""
+        while True:
+            try:
+                return self.get(name).batcher.submit(img)
+            except ModelUnloaded:
+                continue
+
+    def queue_depth(self) -> int:
+        with self._lock:
+            return sum(r.batcher.depth for r in self._runtimes.values())
+
+    def status(self):
+        with self._lock:
+            return {
+                name: dict(state, resident_mb=round(self._runtimes[name].resident_bytes / 1e6, 1)
+                           if name in self._runtimes else 0.0)
+                for name, state in self._state.items()
+            }
+
+    def _load_in_background(self, name, event):
+        try:
+            self.load(name)
+        except Exception as e:
+            print(f"Model load failed for {name}: {e}")
+        finally:
+            with self._lock:
+                self._loaded_events.pop(name, None)
+            event.set()
+
+    def _evict_locked(self, keep):
+        total = sum(r.resident_bytes for r in self._runtimes.values())
+        for name in list(self._runtimes):
+            if total <= self.max_bytes:
+                break
+            if name == keep or name in self.pinned:
+                continue
+            runtime = self._runtimes.pop(name)
+            runtime.close()
+            total -= runtime.resident_bytes
+            self._state[name] = {"state": "unloaded", "error": None}
+            print(f"Model unloaded to stay within memory budget: {name}")
+
+model_registry = ModelRegistry([_model_key(m, p) for p in PRECISIONS for m in AVAILABLE_MODELS],
+                               pinned=(_model_key(DEFAULT_MODEL, REMBG_PRECISION),))
+Gauge("removebg_batch_queue_depth", "Images waiting for batched inference.", model_registry.queue_depth)
+# Gauges are per process; with several gunicorn workers this says which one a scrape reached
+Gauge("removebg_worker_pid", "PID of the worker process that served this scrape.", os.getpid)
+
+# Tools that import this module for its helpers set REMBG_DEFER_PRELOAD=1 to skip the preload;
+# gunicorn.conf.py sets it too and calls preload_for_fork() in the master once it is
+# listening, then import_rembg_after_fork() in each worker
+if os.environ.get("REMBG_DEFER_PRELOAD") != "1":
+    threading.Thread(target=_preload_rembg, daemon=True).start()
+
+class ResultCache:
+    """Content-addressed cache of encoded results.
+
+    Keys are a hash of the uploaded bytes plus every option that affects the
+    output. Entries live in an LRU bounded by total body size; when a disk
+    directory is configured, results are also written there and promoted back
+    into memory on a hit.
+    """
+
+    def __init__(self, max_bytes: int = RESULT_CACHE_MAX_BYTES, disk_dir=RESULT_CACHE_DIR):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(data: bytes, **options) -> str:
+        return ResultCache.key_from_hash(ResultCache.new_hash(data), **options)
+
+    @staticmethod
+    def new_hash(data: bytes = b""):
+        """Hash of the upload bytes; UploadSink feeds it chunk by chunk as the body arrives."""
+        return hashlib.blake2b(data, digest_size=16)
+
+    @staticmethod
+    def key_from_hash(h, **options) -> str:
+        h = h.copy()
+        h.update(json.dumps(options, sort_keys=True).encode())
+        return h.hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry
+        entry = self._read_disk(key)
+        if entry is not None:
+            self._store(key, entry)
+        return entry
+
+    def put(self, key: str, body: bytes, mimetype: str, headers=None):
+        entry = (body, mimetype, dict(headers or {}))
+        self._store(key, entry)
+        self._write_disk(key, entry)
+
+    def _store(self, key, entry):
+        size = len(entry[0])
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old[0])
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted[0])
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], key)
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path + ".json") as f:
+                meta = json.load(f)
+            with open(path + ".bin", "rb") as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        return (body, meta["mimetype"], meta.get("headers", {}))
+
+    def _write_disk(self, key, entry):
+        if not self.disk_dir:
+            return
+        body, mimetype, headers = entry
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write atomically so concurrent readers never see partial files
+            for suffix, payload in ((".bin", body), (".json", json.dumps({"mimetype": mimetype, "headers": headers}).encode())):
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+                with os.fdopen(fd, "wb") as f:
+                    f.write(payload)
+                os.replace(tmp, path + suffix)
+        except OSError as e:
+            print(f"Result cache disk write failed (continuing): {e}")
+
+result_cache = ResultCache()
+
+def _send_result(body: bytes, mimetype: str, headers, etag: str, cache_status: str):
+    # Werkzeug only answers If-None-Match for GET and HEAD, but results are content-addressed,
+    # so a client already holding this ETag gets a 304 for POST /remove-bg too
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+    else:
+        resp = send_file(io.BytesIO(body), mimetype=mimetype, etag=etag)
+    resp.headers.update(headers)
+    resp.headers["X-Cache"] = cache_status
+    resp.vary.add("Accept")
+    return resp
+
+def _mask_result(fut: Future, deadline: float) -> Image.Image:
+    """Wait for a batched mask, giving up with PoolTimeout if no worker has taken it by the deadline."""
+    try:
+        return fut.result(timeout=max(0.0, deadline - time.monotonic()))
+    except FutureTimeout:
+        if fut.cancel():
+            raise PoolTimeout("Timed out waiting for an inference session")
+        # A worker is already running it, so the result is close
+        return fut.result()
+
+def _predict_mask(img: Image.Image, model: str, engine: str = REMBG_ENGINE) -> Image.Image:
+    """Predict the 8-bit subject mask for an image with the selected engine."""
+    if engine == "native":
+        try:
+            deadline = time.monotonic() + SESSION_WAIT_TIMEOUT
+            return _mask_result(model_registry.submit(model, img), deadline)
+        except (PoolTimeout, ModelLoading):
+            raise
+        except Exception as e:
+            if remove_fn is None:
+                raise
+            print(f"Native engine failed, falling back to rembg: {e}")
+    if remove_fn is None:
+        raise RequestError("rembg engine not loaded", 503)
+    with model_registry.get(model).pool.checkout() as sess:
+        return remove_fn(img, session=_rembg_session(sess), only_mask=True).convert("L")
+
+def _encode(img: Image.Image, fmt: str, quality: int = WEBP_QUALITY, lossless: bool = False,
+            compress_level: int = PNG_COMPRESS_LEVEL):
+    """Encode an image for the response, returning (body, mimetype, headers)."""
+    if fmt == "raw":
+        # Raw 8-bit mask rows, dimensions carried in headers
+        body, mimetype = img.tobytes(), "application/octet-stream"
+        headers = {"X-Mask-Width": str(img.width), "X-Mask-Height": str(img.height)}
+    else:
+        buf = io.BytesIO()
+        if fmt == "webp":
+            img.save(buf, format="WEBP", lossless=lossless, quality=quality, method=WEBP_METHOD)
+        else:
+            img.save(buf, format="PNG", compress_level=compress_level, optimize=False)
+        body, mimetype, headers = buf.getvalue(), OUTPUT_MIMETYPES[fmt], {}
+    return body, mimetype, headers
+
+def _int_param(name: str, default: int, lo: int, hi: int) -> int:
+    """Read an integer request parameter, raising a 400 RequestError when invalid or out of range."""
+    raw = request.values.get(name)
+    if raw in (None, ""):
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        raise RequestError(f"Invalid '{name}', expected an integer", 400)
+    if not lo <= value <= hi:
+        raise RequestError(f"Invalid '{name}', expected a value between {lo} and {hi}", 400)
+    return value
+
+def _negotiate_format() -> str:
+    """Pick the output format from the 'format' parameter or the Accept header."""
+    fmt = request.values.get("format")
+    if fmt:
+        return fmt
+    best = request.accept_mimetypes.best_match(list(OUTPUT_MIMETYPES.values()), default="image/png")
+    return next(name for name, mimetype in OUTPUT_MIMETYPES.items() if mimetype == best)
+
+def _fit_size(size, max_dim: int):
+    """Scale (w, h) to fit within max_dim, preserving aspect ratio."""
+    w, h = size
+    scale = max_dim / max(w, h)
+    return (max(1, round(w * scale)), max(1, round(h * scale)))
 
 def downscale_if_needed(img: Image.Image, max_dim: int = 800) -> Image.Image:
     try:
-        w, h = img.size
-        if max(w, h) > max_dim:
-            # Use thumbnail to preserve aspect ratio and reduce memory
-            img = img.copy()
-            img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+        if max_dim and max(img.size) > max_dim:
+            size = _fit_size(img.size, max_dim)
+            # For a JPEG that is not loaded yet, decode directly at 1/2, 1/4 or 1/8 scale
+            img.draft(None, size)
+            # Palette and exotic modes would otherwise be resized with NEAREST
+            if img.mode not in ("RGB", "RGBA", "L", "LA"):
+                img = img.convert("RGBA")
+            # reducing_gap shrinks by an integer factor with reduce() before the LANCZOS pass
+            img = img.resize(size, Image.LANCZOS, reducing_gap=3.0)
         return img
     except Exception:
         # If anything goes wrong, return original image
         return img
 
+def _inference_copy(img: Image.Image, model_name: str) -> Image.Image:
+    """Downscaled copy of the image for mask prediction.
+
+    The model resizes its input to a fixed size anyway, so predicting on a
+    small copy costs the same regardless of the upload's resolution.
+    """
+    dim = max(INFERENCE_DIM, *MODEL_INPUTS[model_name][0])
+    return downscale_if_needed(img, max_dim=dim).convert("RGBA")
+
+def _refine_tiles(coarse: Image.Image, size, tile: int):
+    """Output-space tiles of the given side holding the most uncertain pixels of the coarse mask."""
+    lo, hi = REFINE_BAND
+    m = np.asarray(coarse)
+    band = (m > lo) & (m < hi)
+    sx, sy = coarse.width / size[0], coarse.height / size[1]
+    scored = []
+    for top in range(0, size[1], tile):
+        for left in range(0, size[0], tile):
+            box = (left, top, min(left + tile, size[0]), min(top + tile, size[1]))
+            count = int(band[int(box[1] * sy):int(np.ceil(box[3] * sy)),
+                             int(box[0] * sx):int(np.ceil(box[2] * sx))].sum())
+            if count:
+                scored.append((count, box))
+    scored.sort(reverse=True)
+    return [box for _, box in scored[:REFINE_MAX_TILES]]
+
+def _refine_edges(img: Image.Image, coarse: Image.Image, mask: Image.Image, model_key: str,
+                  engine: str = REMBG_ENGINE) -> Image.Image:
+    """Sharpen the mask by re-predicting crops around its uncertain edges.
+
+    Tiles are chosen on the coarse (inference-size) mask. Each is cropped from
+    the full-resolution image with some context and run through the model on
+    its own, so the model sees the edge REFINE_ZOOM times larger. Refined
+    values are blended in by how uncertain the upsampled mask was, so
+    confident interior and background pixels keep their coarse value.
+    """
+    model_name = _split_model_key(model_key)[0]
+    w, h = img.size
+    tile = max(max(MODEL_INPUTS[model_name][0]), -(-max(w, h) // REFINE_ZOOM))
+    if max(w, h) < 2 * tile:
+        # The coarse pass already saw the image at (nearly) this resolution
+        return mask
+    boxes = _refine_tiles(coarse, img.size, tile)
+    if not boxes:
+        return mask
+    margin = tile // 4
+    contexts = [(max(0, l - margin), max(0, t - margin), min(w, r + margin), min(h, b + margin))
+                for l, t, r, b in boxes]
+    crops = [_inference_copy(img.crop(ctx), model_name) for ctx in contexts]
+    if engine == "native":
+        # Submit every crop before waiting so they share micro-batches
+        deadline = time.monotonic() + SESSION_WAIT_TIMEOUT
+        futures = [model_registry.submit(model_key, crop) for crop in crops]
+        try:
+            refined = [_mask_result(fut, deadline) for fut in futures]
+        except PoolTimeout:
+            for fut in futures:
+                fut.cancel()
+            raise
+    else:
+        refined = [_predict_mask(crop, model_key, engine) for crop in crops]
+
+    out = np.array(mask)
+    for (l, t, r, b), ctx, pred in zip(boxes, contexts, refined):
+        sharp = np.asarray(_upsample_mask(pred, (ctx[2] - ctx[0], ctx[3] - ctx[1])), dtype=np.float32)
+        sharp = sharp[t - ctx[1]:b - ctx[1], l - ctx[0]:r - ctx[0]]
+        old = out[t:b, l:r].astype(np.float32)
+        # 1 across the middle of the alpha range, falling to 0 at fully opaque or transparent
+        weight = np.clip(2.0 - np.abs(old * (4.0 / 255) - 2.0), 0.0, 1.0)
+        out[t:b, l:r] = (old + weight * (sharp - old) + 0.5).astype(np.uint8)
+    return Image.fromarray(out, mode="L")
+
+def _box_filter_1d(a: np.ndarray, r: int, axis: int) -> np.ndarray:
+    """Mean over a window of 2r+1 along one axis, shrinking the window at the borders."""
+    n = a.shape[axis]
+    pad = [(0, 0)] * a.ndim
+    pad[axis] = (1, 0)
+    c = np.pad(np.cumsum(a, axis=axis, dtype=np.float32), pad)
+    idx = np.arange(n)
+    hi, lo = np.minimum(idx + r + 1, n), np.maximum(idx - r, 0)
+    shape = [1] * a.ndim
+    shape[axis] = n
+    return (np.take(c, hi, axis=axis) - np.take(c, lo, axis=axis)) / (hi - lo).astype(np.float32).reshape(shape)
+
+def _box_mean(a: np.ndarray, r: int) -> np.ndarray:
+    """Separable (2r+1)x(2r+1) box mean in O(1) per pixel via cumulative sums."""
+    return _box_filter_1d(_box_filter_1d(a, r, 0), r, 1)
+
+def _guided_coefficients(guide: np.ndarray, src: np.ndarray, r: int, eps: float):
+    """Box-smoothed guided filter coefficients (He et al.): the filtered src is a * guide + b.
+
+    guide and src are float32 in [0, 1]; every step is a box mean, so the
+    cost is O(1) per pixel whatever the radius.
+    """
+    mean_g, mean_p = _box_mean(guide, r), _box_mean(src, r)
+    var_g = _box_mean(guide * guide, r) - mean_g * mean_g
+    a = (_box_mean(guide * src, r) - mean_g * mean_p) / (var_g + eps)
+    b = mean_p - a * mean_g
+    return _box_mean(a, r), _box_mean(b, r)
+
+def _rank_filter_1d(a: np.ndarray, r: int, axis: int, op) -> np.ndarray:
+    """Running np.minimum/np.maximum over a window of 2r+1 along one axis, borders replicated.
+
+    Spans double on each pass, so a radius costs O(log r) vectorized passes.
+    """
+    if r <= 0:
+        return a
+    a = np.moveaxis(a, axis, 0)
+    n, width = a.shape[0], 2 * r + 1
+    acc = np.concatenate([np.repeat(a[:1], r, axis=0), a, np.repeat(a[-1:], r, axis=0)])
+    span = 1
+    # acc[i] holds op over span consecutive padded values starting at i
+    while span * 2 <= width:
+        acc = op(acc[:-span], acc[span:])
+        span *= 2
+    # Two overlapping spans cover the whole window
+    out = op(acc[:n], acc[width - span:width - span + n])
+    return np.moveaxis(out, 0, axis)
+
+def _erode(m: np.ndarray, r: int) -> np.ndarray:
+    return _rank_filter_1d(_rank_filter_1d(m, r, 0, np.minimum), r, 1, np.minimum)
+
+def _dilate(m: np.ndarray, r: int) -> np.ndarray:
+    return _rank_filter_1d(_rank_filter_1d(m, r, 0, np.maximum), r, 1, np.maximum)
+
+def _clean_mask(mask: Image.Image, threshold: int = 0, fill_holes: int = 0, erode: int = 0,
+                dilate: int = 0, feather: int = 0) -> Image.Image:
+    """Apply the requested mask cleanups in order, with square structuring elements.
+
+    threshold binarizes at that alpha, fill_holes closes gaps up to about twice
+    its radius, erode/dilate shrink or grow the subject and feather softens
+    the edge with a two-pass box blur. Radii are in output pixels; 0 skips a step.
+    """
+    m = np.asarray(mask)
+    if threshold:
+        m = np.where(m >= threshold, np.uint8(255), np.uint8(0))
+    if fill_holes:
+        m = _erode(_dilate(m, fill_holes), fill_holes)
+    if erode:
+        m = _erode(m, erode)
+    if dilate:
+        m = _dilate(m, dilate)
+    if feather:
+        f = m.astype(np.float32)
+        for _ in range(2):
+            f = _box_mean(f, max(1, feather // 2))
+        m = (f + 0.5).astype(np.uint8)
+    return Image.fromarray(np.ascontiguousarray(m), mode="L")
+
+def _subject_box(mask: Image.Image, padding: int = 0):
+    """Bounding box of the subject in the mask plus padding, or None if the mask is empty."""
+    solid = np.asarray(mask) >= CROP_MIN_ALPHA
+    rows, cols = np.flatnonzero(solid.any(axis=1)), np.flatnonzero(solid.any(axis=0))
+    if rows.size == 0:
+        return None
+    return (max(0, int(cols[0]) - padding), max(0, int(rows[0]) - padding),
+            min(mask.width, int(cols[-1]) + 1 + padding), min(mask.height, int(rows[-1]) + 1 + padding))
+
+# Running estimates of the matting costs, used to fit each request in its budget: the
+# guided filter solve per solved pixel and the full-resolution apply per output pixel
+_matting_solve_ns = 60.0
+_matting_apply_ns = 30.0
+
+def _alpha_matte(img: Image.Image, small_img: Image.Image, mask: Image.Image,
+                 budget_ms: int = MATTING_BUDGET_MS) -> Image.Image:
+    """Soft alpha from a trimap of the mask, solved with a guided filter on the unknown band only.
+
+    A fast stand-in for rembg's pymatting path: definite foreground and
+    background become 255 and 0. The trimap and the filter solve run on
+    small_img, the inference copy, so their cost does not grow with the
+    output resolution; the coefficients are then applied at full resolution
+    on the band's tiles only (the fast guided filter). budget_ms covers the
+    whole call: the solve is subsampled to fit half of what remains, and
+    tiles are applied, most uncertain first, while their estimated cost
+    fits. Tiles left over keep the upsampled mask.
+    """
+    global _matting_solve_ns, _matting_apply_ns
+    deadline = time.perf_counter() + max(budget_ms, 1) / 1000
+    m = np.asarray(mask)
+    out = (m >= MATTING_FG_THRESHOLD).view(np.uint8)
+    out *= 255
+    small = mask
+    if mask.size != small_img.size:
+        # reducing_gap shrinks by an integer factor with reduce() first, several times faster
+        small = mask.resize(small_img.size, Image.BOX, reducing_gap=1.0)
+    coarse = np.asarray(small)
+    unknown = (coarse > MATTING_BG_THRESHOLD) & (coarse < MATTING_FG_THRESHOLD)
+    band = _dilate(unknown.astype(np.uint8), MATTING_ERODE)
+    rows, cols = np.flatnonzero(band.any(axis=1)), np.flatnonzero(band.any(axis=0))
+    if rows.size == 0:
+        return Image.fromarray(out, mode="L")
+
+    # Solve on the band's bounding box in the inference copy, subsampled if needed
+    left, top, right, bottom = int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+    guide = np.asarray(small_img.crop((left, top, right, bottom)).convert("L"), dtype=np.float32) / 255
+    src = coarse[top:bottom, left:right].astype(np.float32) / 255
+    h, w = guide.shape
+    remaining_ns = max(deadline - time.perf_counter(), 0.0) * 1e9
+    step = max(1, min(16, int(np.ceil(np.sqrt(w * h * _matting_solve_ns / max(remaining_ns / 2, 1.0))))))
+    if step > 1:
+        size = (max(1, w // step), max(1, h // step))
+        guide = np.asarray(Image.fromarray(guide, mode="F").resize(size, Image.BILINEAR))
+        src = np.asarray(Image.fromarray(src, mode="F").resize(size, Image.BILINEAR))
+    start = time.perf_counter()
+    a, b = _guided_coefficients(guide, src, max(1, round(MATTING_RADIUS / step)), MATTING_EPS)
+    _matting_solve_ns = 0.8 * _matting_solve_ns + 0.2 * (time.perf_counter() - start) * 1e9 / guide.size
+    a_img, b_img = Image.fromarray(a, mode="F"), Image.fromarray(b, mode="F")
+    gx, gy = a.shape[1] / w, a.shape[0] / h
+
+    # Band tiles within the bounding box, most uncertain first
+    t = MATTING_TILE
+    th, tw = -(-(bottom - top) // t), -(-(right - left) // t)
+    counts = np.zeros((th * t, tw * t), dtype=np.int32)
+    counts[:bottom - top, :right - left] = unknown[top:bottom, left:right]
+    counts = counts.reshape(th, t, tw, t).sum(axis=(1, 3))
+    tiled = np.zeros((th * t, tw * t), dtype=np.uint8)
+    tiled[:bottom - top, :right - left] = band[top:bottom, left:right]
+    in_band = tiled.reshape(th, t, tw, t).any(axis=(1, 3))
+    tiles = sorted(zip(*np.nonzero(in_band)), key=lambda ij: -counts[ij])
+
+    sx, sy = mask.width / small.width, mask.height / small.height
+
+    def tile_box(i, j):
+        # Tile corners in the inference copy, scaled to the output
+        l, u = left + j * t, top + i * t
+        r, d = min(right, l + t), min(bottom, u + t)
+        return (int(l * sx), int(u * sy), min(mask.width, int(np.ceil(r * sx))), min(mask.height, int(np.ceil(d * sy))))
+
+    for n, (i, j) in enumerate(tiles):
+        box = tile_box(i, j)
+        size = (box[2] - box[0], box[3] - box[1])
+        if time.perf_counter() + size[0] * size[1] * _matting_apply_ns / 1e9 > deadline:
+            # Out of budget: the remaining tiles keep the mask as predicted
+            for i, j in tiles[n:]:
+                l, u, r, d = tile_box(i, j)
+                out[u:d, l:r] = m[u:d, l:r]
+            break
+        start = time.perf_counter()
+        coeff_box = ((box[0] / sx - left) * gx, (box[1] / sy - top) * gy,
+                     (box[2] / sx - left) * gx, (box[3] / sy - top) * gy)
+        ta = np.asarray(a_img.resize(size, Image.BILINEAR, box=coeff_box))
+        tb = np.asarray(b_img.resize(size, Image.BILINEAR, box=coeff_box))
+        g = np.asarray(img.crop(box).convert("L"), dtype=np.float32) / 255
+        alpha = ta * g + tb
+        out[box[1]:box[3], box[0]:box[2]] = (np.clip(alpha, 0.0, 1.0) * 255 + 0.5).astype(np.uint8)
+        _matting_apply_ns = 0.8 * _matting_apply_ns + 0.2 * (time.perf_counter() - start) * 1e9 / g.size
+    return Image.fromarray(out, mode="L")
+
+def _draft_scale(fmt: str, size, max_dim: int) -> int:
+    """JPEG draft reduction (1, 2, 4 or 8) the pipeline decodes an image at."""
+    if fmt not in ("JPEG", "MPO"):
+        return 1
+    w, h = size
+    factor = 1
+    if max_dim and max(w, h) > max_dim:
+        target_w, target_h = _fit_size(size, max_dim)
+        # Same choice as JpegImageFile.draft: the largest 1/n scale not below the target
+        ratio = min(w // target_w, h // target_h)
+        factor = next(f for f in (8, 4, 2, 1) if f <= ratio)
+    # A JPEG that would still decode above the limit is drafted further instead of rejected
+    while factor < 8 and -(-w // factor) * -(-h // factor) > MAX_PIXELS:
+        factor *= 2
+    return factor
+
+def _draft_size(fmt: str, size, max_dim: int):
+    """Size to pass to Image.draft before decoding, or None to decode at full size."""
+    factor = _draft_scale(fmt, size, max_dim)
+    if factor == 1:
+        return None
+    return (max(1, size[0] // factor), max(1, size[1] // factor))
+
+def _decoded_size(fmt: str, size, max_dim: int):
+    factor = _draft_scale(fmt, size, max_dim)
+    return (-(-size[0] // factor), -(-size[1] // factor))
+
+def _decoded_pixels(fmt: str, size, max_dim: int) -> int:
+    """Pixels that decoding will allocate, accounting for JPEG draft scaling."""
+    w, h = _decoded_size(fmt, size, max_dim)
+    return w * h
+
+def _check_pixels(fmt: str, size, max_dim: int) -> int:
+    """Reject images whose decode would exceed the per-request pixel limit.
+
+    Returns the share of the concurrent budget the request holds from decode through encode.
+    """
+    w, h = _decoded_size(fmt, size, max_dim)
+    if w * h > MAX_PIXELS:
+        raise RequestError(
+            f"Image {size[0]}x{size[1]} exceeds the {MAX_PIXELS / 1e6:g} megapixel limit", 413)
+    out_w, out_h = _fit_size((w, h), max_dim) if max_dim and max(w, h) > max_dim else (w, h)
+    return w * h + WORKING_PIXELS_PER_OUTPUT_PIXEL * out_w * out_h
+
+class PixelBudget:
+    """Counting budget of decoded pixels shared by all in-flight requests."""
+
+    def __init__(self, limit: int = CONCURRENT_PIXELS):
+        self.limit = limit
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def _cost(self, pixels: int) -> int:
+        # An image larger than the whole budget may still run, but only on its own
+        return min(pixels, self.limit)
+
+    def try_acquire(self, pixels: int) -> bool:
+        with self._cond:
+            if self.used + self._cost(pixels) > self.limit:
+                return False
+            self.used += self._cost(pixels)
+            return True
+
+    def acquire(self, pixels: int, timeout: float = PIXEL_WAIT_TIMEOUT):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.used + self._cost(pixels) <= self.limit, timeout):
+                raise RequestError("Server is busy decoding other images, please retry", 503)
+            self.used += self._cost(pixels)
+
+    def release(self, pixels: int):
+        if not pixels:
+            return
+        with self._cond:
+            self.used -= self._cost(pixels)
+            self._cond.notify_all()
+
+pixel_budget = PixelBudget()
+Gauge("removebg_decode_pixels_in_use", "Decoded pixels currently reserved by in-flight requests.",
+      lambda: pixel_budget.used)
+
+class UploadSink(io.BytesIO):
+    """Upload buffer that inspects the image while the body is still arriving.
+
+    Every write is kept and hashed for the result cache key as it arrives
+    and, until the header is identified, sniffed with Image.open. Bad
+    formats and oversized dimensions are raised from write(), which aborts
+    the upload early; check() runs the last sniff once the body is complete.
+    Only checks that hold for any max_dim run here; _process applies the
+    pixel limit with the request's options. With decode=True the remaining
+    bytes are fed into an ImageFile.Parser so decoding overlaps with the
+    network receive. JPEGs the pipeline would draft are left for the draft
+    decode in _process, which is cheaper than a full-size incremental decode.
+    The incremental decode reserves its pixels from the shared budget up
+    front and is skipped when the budget is full.
+    """
+
+    def __init__(self, decode: bool = False):
+        super().__init__()
+        self.decode = decode
+        self.hash = ResultCache.new_hash()
+        self.header = None
+        self.reserved_pixels = 0
+        self.error = None
+        self._parser = None
+
+    def write(self, chunk) -> int:
+        n = super().write(chunk)
+        self.hash.update(chunk)
+        if self.header is None and self.error is None:
+            self._sniff()
+            if self.error is not None:
+                raise self.error
+        elif self._parser is not None:
+            self._feed(chunk)
+        return n
+
+    def check(self):
+        """Raise the problem found in the upload, sniffing one last time now the body is complete."""
+        if self.header is None and self.error is None:
+            self._sniff(final=True)
+        if self.error is not None:
+            raise self.error
+
+    def _sniff(self, final: bool = False):
+        data = self.getvalue()
+        try:
+            with Image.open(io.BytesIO(data)) as im:
+                fmt, size = im.format, im.size
+        except Image.DecompressionBombError as e:
+            self.error = RequestError(str(e), 413)
+            return
+        except Exception:
+            # Header not complete yet; give up once far more than any header has arrived
+            if final or len(data) > UPLOAD_SNIFF_LIMIT:
+                self.error = RequestError("Unsupported or unrecognized image format", 415)
+            return
+        if fmt not in UPLOAD_FORMATS:
+            self.error = RequestError(f"Unsupported image format: {fmt}", 415)
+            return
+        if max(size) > UPLOAD_MAX_SIDE:
+            self.error = RequestError(
+                f"Image dimensions {size[0]}x{size[1]} exceed the {UPLOAD_MAX_SIDE}px limit", 413)
+            return
+        try:
+            # Without a cap JPEGs are drafted to fit, so this only rejects formats that
+            # always decode at full size, whatever max_dim the request asks for
+            _check_pixels(fmt, size, 0)
+        except RequestError as e:
+            self.error = e
+            return
+        self.header = (fmt, size)
+        if self.decode and _draft_scale(fmt, size, MAX_DIM) == 1:
+            pixels = size[0] * size[1]
+            if pixel_budget.try_acquire(pixels):
+                self.reserved_pixels = pixels
+                self._parser = ImageFile.Parser()
+                self._feed(self.getvalue())
+
+    def _feed(self, chunk):
+        try:
+            self._parser.feed(bytes(chunk))
+        except Exception:
+            # Fall back to decoding the buffered bytes once the upload is complete
+            self._parser = None
+
+    def image(self):
+        """Return the incrementally decoded image, or None if it must be decoded from bytes."""
+        if self._parser is None:
+            return None
+        try:
+            return self._parser.close()
+        except Exception:
+            return None
+        finally:
+            self._parser = None
+
+    def take_reserved_pixels(self) -> int:
+        """Hand the pixel reservation over to the caller, who must release it."""
+        pixels, self.reserved_pixels = self.reserved_pixels, 0
+        return pixels
+
+    def close(self):
+        pixel_budget.release(self.take_reserved_pixels())
+        super().close()
+
+# Endpoints whose uploads are a single image; everything else (batch archives) is spooled as usual
+UPLOAD_ENDPOINTS = ("remove_bg", "submit_job")
+
+def _upload_sink(endpoint: str) -> UploadSink:
+    # Decoding runs even when the result cache may answer: the key is hashed as the body
+    # arrives, so a miss finds the image already decoded and a hit only wastes the decode.
+    # A max_dim in the query string means the JPEG draft decode is likely cheaper. One sent
+    # as a form field may arrive after the file; the decoded image is then resized instead.
+    decode = endpoint == "remove_bg" and "max_dim" not in request.args
+    return UploadSink(decode=decode)
+
+class UploadMultiPartParser(MultiPartParser):
+    """Multipart parser that streams the 'image' field of single-image endpoints into an UploadSink.
+
+    Errors raised by the sink abort the parse, so a bad image is rejected
+    before the rest of the body is read. Other file fields are spooled as usual.
+    """
+
+    def start_file_streaming(self, event, total_content_length):
+        if event.name == "image" and request.endpoint in UPLOAD_ENDPOINTS:
+            return _upload_sink(request.endpoint)
+        return super().start_file_streaming(event, total_content_length)
+
+class UploadFormDataParser(FormDataParser):
+    """FormDataParser that parses multipart bodies with UploadMultiPartParser."""
+
+    def _parse_multipart(self, stream, mimetype, content_length, options):
+        parser = UploadMultiPartParser(
+            stream_factory=self.stream_factory,
+            max_form_memory_size=self.max_form_memory_size,
+            max_form_parts=self.max_form_parts,
+            cls=self.cls,
+        )
+        boundary = options.get("boundary", "").encode("ascii")
+        if not boundary:
+            raise ValueError("Missing boundary")
+        form, files = parser.parse(stream, boundary, content_length)
+        return stream, form, files
+
+class StreamingRequest(Request):
+    """Request that streams the image field of single-image endpoints into an UploadSink."""
+
+    form_data_parser_class = UploadFormDataParser
+
+app.request_class = StreamingRequest
+
+def _read_upload():
+    """Return the upload from the 'image' field or a raw image body, or None if missing.
+
+    Raises RequestError when the upload is not an acceptable image.
+    """
+    if request.mimetype.startswith("image/") or request.mimetype == "application/octet-stream":
+        sink = g.raw_upload = _upload_sink(request.endpoint)
+        while True:
+            chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            # Raises as soon as the image is known to be bad, leaving the rest of the body unread
+            sink.write(chunk)
+        if not sink.tell():
+            return None
+        sink.check()
+        return sink
+    # Parsing the form raises the sink's error as soon as the image field turns out bad
+    file = request.files.get("image")
+    if file is None:
+        return None
+    if isinstance(file.stream, UploadSink):
+        file.stream.check()
+    return file.stream
+
+@app.teardown_request
+def _close_raw_upload(exc):
+    # Multipart sinks are closed with request.files; raw bodies are closed here
+    sink = g.pop("raw_upload", None)
+    if sink is not None:
+        sink.close()
+
+def _parse_options() -> dict:
+    """Collect and validate processing options from the current request."""
+    model = request.values.get("model") or DEFAULT_MODEL
+    if model not in AVAILABLE_MODELS:
+        raise RequestError(f"Unknown model '{model}', expected one of: {', '.join(AVAILABLE_MODELS)}", 400)
+    precision = request.values.get("precision") or REMBG_PRECISION
+    if precision not in PRECISIONS:
+        raise RequestError(f"Invalid 'precision', expected one of: {', '.join(PRECISIONS)}", 400)
+    # Without this check each request would start a background load that can only fail
+    if precision == "int8" and not os.path.exists(_quantized_model_path(model)):
+        raise RequestError(f"No INT8 variant of '{model}' is available, use precision=fp32", 400)
+
+    # output=mask returns only the single-channel alpha mask, skipping RGBA composition
+    output = request.values.get("output") or "cutout"
+    if output not in ("cutout", "mask"):
+        raise RequestError("Invalid 'output', expected 'cutout' or 'mask'", 400)
+    fmt = _negotiate_format()
+    if fmt not in OUTPUT_MIMETYPES and not (fmt == "raw" and output == "mask"):
+        raise RequestError("Invalid 'format', expected 'png' or 'webp' (or 'raw' with output=mask)", 400)
+    crop = request.values.get("crop") or "none"
+    if crop not in ("none", "subject"):
+        raise RequestError("Invalid 'crop', expected 'none' or 'subject'", 400)
+    return {
+        "model": model,
+        "precision": precision,
+        "engine": REMBG_ENGINE,
+        "max_dim": _int_param("max_dim", MAX_DIM, 0, UPLOAD_MAX_SIDE),
+        "output": output,
+        "format": fmt,
+        "quality": _int_param("quality", WEBP_QUALITY, 0, 100),
+        "lossless": _int_param("lossless", 0, 0, 1) == 1,
+        "compress_level": _int_param("compress_level", PNG_COMPRESS_LEVEL, 0, 9),
+        # refine=1 re-runs the model on full-resolution crops around uncertain edges
+        "refine": _int_param("refine", 0, 0, 1) == 1,
+        "alpha_matting": _int_param("alpha_matting", 0, 0, 1) == 1,
+        "matting_budget_ms": _int_param("matting_budget_ms", MATTING_BUDGET_MS, 1, 10000),
+        # Mask cleanups applied before compositing, see _clean_mask
+        "threshold": _int_param("threshold", 0, 0, 255),
+        "fill_holes": _int_param("fill_holes", 0, 0, 100),
+        "erode": _int_param("erode", 0, 0, 100),
+        "dilate": _int_param("dilate", 0, 0, 100),
+        "feather": _int_param("feather", 0, 0, 100),
+        # crop=subject trims the result to the subject's bounding box plus crop_padding pixels
+        "crop": crop,
+        "crop_padding": _int_param("crop_padding", 0, 0, UPLOAD_MAX_SIDE),
+    }
+
+def _check_ready():
+    # If model not ready yet, fail fast with 503 instead of trying to import within request
+    if not ready_event.is_set():
+        NOT_READY.inc()
+        raise RequestError("Model not ready, please retry in a few seconds", 503)
+
+    # If preload failed, return 500 with explicit message for diagnosis
+    if preload_error is not None:
+        raise RequestError(f"Model preload failed: {preload_error}", 500)
+
+    if REMBG_ENGINE == "rembg" and remove_fn is None:
+        raise RequestError("Model not loaded", 500)
+
+def _process(data: bytes, opts: dict, upload: UploadSink = None, timer: StageTimer = None):
+    """Run the pipeline on uploaded bytes.
+
+    When the upload was streamed into an UploadSink, its incrementally decoded
+    image is used instead of decoding the bytes again. Stage durations are
+    recorded on `timer`.
+    Returns (body, mimetype, headers, cache_key, cache_status).
+    """
+    timer = timer or StageTimer()
+    # Serve repeated uploads straight from the cache, skipping decode, inference and encode
+    if isinstance(upload, UploadSink):
+        cache_key = ResultCache.key_from_hash(upload.hash, **opts)
+    else:
+        cache_key = ResultCache.make_key(data, **opts)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        CACHE_REQUESTS.inc(result="hit")
+        return (*cached, cache_key, "HIT")
+    CACHE_REQUESTS.inc(result="miss")
+
+    _check_ready()
+
+    # The sink's reservation covers an image it decoded during the upload; `working`
+    # adds the buffers needed from there to the encoded result
+    pixels = upload.take_reserved_pixels() if isinstance(upload, UploadSink) else 0
+    working = 0
+    try:
+        with timer.stage("decode"):
+            img = upload.image() if isinstance(upload, UploadSink) else None
+            if img is not None:
+                fmt, size = upload.header
+                working = _check_pixels(fmt, size, opts["max_dim"]) - _decoded_pixels(fmt, size, opts["max_dim"])
+                pixel_budget.acquire(working)
+                megapixels = img.width * img.height / 1e6
+            else:
+                pixel_budget.release(pixels)
+                pixels = 0
+                # Image.open only reads the header, so the guard runs before pixels are allocated
+                img = Image.open(io.BytesIO(data))
+                needed = _check_pixels(img.format, img.size, opts["max_dim"])
+                pixel_budget.acquire(needed)
+                pixels = needed
+                megapixels = img.width * img.height / 1e6
+                # Decode near the target size, or at the largest scale that fits MAX_MEGAPIXELS;
+                # downscale_if_needed's own draft call is then a no-op
+                draft = _draft_size(img.format, img.size, opts["max_dim"])
+                if draft is not None:
+                    img.draft(None, draft)
+            img.load()
+        INPUT_MEGAPIXELS.observe(megapixels)
+        INPUT_MEGAPIXELS_TOTAL.inc(megapixels)
+
+        # The output keeps the (possibly capped) upload resolution; only the model sees
+        # the small copy. Convert to RGBA only after resizing.
+        with timer.stage("resize"):
+            img = downscale_if_needed(img, max_dim=opts["max_dim"])
+            small = _inference_copy(img, opts["model"])
+
+        # Predict the mask through the shared batching queue, then cut out the subject
+        model_key = _model_key(opts["model"], opts["precision"])
+        with timer.stage("inference"):
+            coarse = _predict_mask(small, model_key, opts["engine"])
+        with timer.stage("upsample"):
+            mask = _upsample_mask(coarse, img.size)
+        if opts["refine"]:
+            with timer.stage("refine"):
+                mask = _refine_edges(img, coarse, mask, model_key, opts["engine"])
+        if opts["alpha_matting"]:
+            with timer.stage("matting"):
+                mask = _alpha_matte(img, small, mask, opts["matting_budget_ms"])
+        cleanups = {key: opts[key] for key in ("threshold", "fill_holes", "erode", "dilate", "feather")}
+        if any(cleanups.values()):
+            with timer.stage("postprocess"):
+                mask = _clean_mask(mask, **cleanups)
+        # The crop position within the uncropped result travels in headers, which are cached too
+        crop_headers = {}
+        if opts["crop"] == "subject":
+            with timer.stage("crop"):
+                box = _subject_box(mask, opts["crop_padding"]) or (0, 0, mask.width, mask.height)
+                crop_headers = {"X-Crop-Left": str(box[0]), "X-Crop-Top": str(box[1]),
+                                "X-Original-Width": str(mask.width), "X-Original-Height": str(mask.height)}
+                mask = mask.crop(box)
+                if opts["output"] != "mask":
+                    img = img.crop(box)
+        if opts["output"] == "mask":
+            out_img = mask
+        else:
+            with timer.stage("composite"):
+                out_img = _composite(img, mask)
+
+        # The full-resolution result is still alive while it is encoded
+        with timer.stage("encode"):
+            body, mimetype, headers = _encode(out_img, opts["format"], quality=opts["quality"],
+                                              lossless=opts["lossless"], compress_level=opts["compress_level"])
+    finally:
+        pixel_budget.release(pixels)
+        pixel_budget.release(working)
+    headers = dict(headers, **crop_headers)
+    result_cache.put(cache_key, body, mimetype, headers)
+    headers = dict(headers, **{"X-Encode-Time-Ms": f"{timer.durations['encode'] * 1000:.1f}"})
+    return body, mimetype, headers, cache_key, "MISS"
+
+def _error_status(e: Exception) -> int:
+    """HTTP status for a pipeline error, counted in the error metrics."""
+    if isinstance(e, RequestError):
+        status = e.status
+    elif isinstance(e, Image.DecompressionBombError):
+        status = 413
+    elif isinstance(e, Image.UnidentifiedImageError):
+        status = 415
+    else:
+        status = 500
+    ERRORS.inc(status=status)
+    return status
+
+def _error_response(e: Exception):
+    # Return plaintext errors for easier client-side logging
+    return (str(e), _error_status(e), {"Content-Type": "text/plain"})
+
+class JobQueueFull(RequestError):
+    """Raised when the async job queue has no free slots."""
+
+    status = 503
+
+class JobStore:
+    """In-process async jobs: a bounded queue drained by a fixed set of worker threads.
+
+    Finished jobs keep their result until `ttl` seconds after completion and
+    are purged lazily on the next submit or lookup. When the stored results
+    exceed `max_result_bytes`, the oldest finished jobs are dropped early;
+    the newest result is always kept.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, max_queued: int = JOB_QUEUE_SIZE, ttl: float = JOB_TTL,
+                 max_result_bytes: int = JOB_RESULTS_MAX_BYTES):
+        self.ttl = ttl
+        self.max_result_bytes = max_result_bytes
+        self.result_bytes = 0
+        self._workers = workers
+        self._max_queued = max_queued
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._start_workers()
+        _fork_hooks.add(self)
+
+    def _start_workers(self):
+        self._queue = queue.Queue(maxsize=self._max_queued)
+        for _ in range(self._workers):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def _after_fork(self):
+        self._start_workers()
+
+    def submit(self, data: bytes, opts: dict) -> dict:
+        job = {"id": uuid.uuid4().hex, "status": "queued", "created": time.time(), "finished": None,
+               "error": None, "status_code": None, "result": None}
+        with self._lock:
+            self._expire_locked()
+            self._jobs[job["id"]] = job
+        try:
+            self._queue.put_nowait((job, data, opts))
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job["id"], None)
+            raise JobQueueFull("Job queue is full, please retry later")
+        return self.describe(job)
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def get(self, job_id: str):
+        with self._lock:
+            self._expire_locked()
+            return self._jobs.get(job_id)
+
+    @staticmethod
+    def describe(job: dict) -> dict:
+        return {key: job[key] for key in ("id", "status", "created", "finished", "error", "status_code")}
+
+    def _run(self):
+        while True:
+            job, data, opts = self._queue.get()
+            # Jobs submitted during a cold start stay queued until the model is loaded
+            ready_event.wait()
+            job["status"] = "running"
+            try:
+                body, mimetype, headers, cache_key, _ = _process(data, opts)
+            except Exception as e:
+                job["status"], job["error"] = "failed", str(e)
+                job["status_code"] = _error_status(e)
+                job["finished"] = time.time()
+                continue
+            with self._lock:
+                job["result"] = (body, mimetype, headers, cache_key)
+                job["status"], job["status_code"] = "done", 200
+                job["finished"] = time.time()
+                self.result_bytes += len(body)
+                self._evict_locked(keep=job["id"])
+
+    def _drop_locked(self, job_id: str):
+        job = self._jobs.pop(job_id)
+        if job["result"] is not None:
+            self.result_bytes -= len(job["result"][0])
+
+    def _expire_locked(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [j["id"] for j in self._jobs.values() if j["finished"] and j["finished"] < cutoff]:
+            self._drop_locked(job_id)
+
+    def _evict_locked(self, keep: str):
+        if self.result_bytes <= self.max_result_bytes:
+            return
+        done = sorted((j for j in self._jobs.values() if j["result"] is not None and j["id"] != keep),
+                      key=lambda j: j["finished"])
+        for job in done:
+            if self.result_bytes <= self.max_result_bytes:
+                break
+            self._drop_locked(job["id"])
+
+job_store = JobStore()
+Gauge("removebg_job_queue_depth", "Async jobs waiting for a worker.", lambda: job_store.depth)
+Gauge("removebg_job_result_bytes", "Bytes of finished job results held for download.",
+      lambda: job_store.result_bytes)
+
+# Runs batch items concurrently so they land in the same micro-batches
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_MAX_SIZE * SESSION_POOL_SIZE)
+
+def _batch_inputs():
+    """Collect (name, bytes) pairs from repeated 'image' fields and/or an 'archive' zip."""
+    items = [(f.filename or f"image-{i}", f.read()) for i, f in enumerate(request.files.getlist("image"))]
+    archive = request.files.get("archive")
+    if archive:
+        try:
+            with zipfile.ZipFile(io.BytesIO(archive.read())) as zf:
+                members = [m for m in zf.infolist() if not m.is_dir()]
+                if sum(m.file_size for m in members) > BATCH_MAX_UNZIPPED_BYTES:
+                    raise RequestError("Archive expands beyond the allowed size", 413)
+                items += [(m.filename, zf.read(m)) for m in members[:BATCH_MAX_IMAGES + 1]]
+        except zipfile.BadZipFile:
+            raise RequestError("Invalid 'archive', expected a zip file", 400)
+    if not items:
+        raise RequestError("Missing 'image' file fields or 'archive' zip", 400)
+    if len(items) > BATCH_MAX_IMAGES:
+        raise RequestError(f"Too many images, at most {BATCH_MAX_IMAGES} per batch", 413)
+    return items
+
+def _result_name(name: str, fmt: str) -> str:
+    stem = os.path.splitext(os.path.basename(name))[0] or "image"
+    return f"{stem}.{'bin' if fmt == 'raw' else fmt}"
+
+def _batch_item(name: str, data: bytes, opts: dict) -> dict:
+    try:
+        body, mimetype, headers, _, _ = _process(data, opts)
+        return {"name": name, "file": _result_name(name, opts["format"]), "status": 200,
+                "body": body, "mimetype": mimetype, "headers": headers}
+    except Exception as e:
+        return {"name": name, "file": None, "status": _error_status(e),
+                "error": str(e)}
+
+def _zip_response(results):
+    buf = io.BytesIO()
+    manifest = []
+    # Encoded images are already compressed, so store them as-is
+    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_STORED) as zf:
+        for i, result in enumerate(results):
+            if result["status"] == 200:
+                result["file"] = f"{i:04d}-{result['file']}"
+                zf.writestr(result["file"], result["body"])
+            entry = {k: result.get(k) for k in ("name", "file", "status", "error")}
+            crop = {k[2:].lower(): int(v) for k, v in result.get("headers", {}).items()
+                    if k in ("X-Crop-Left", "X-Crop-Top", "X-Original-Width", "X-Original-Height")}
+            if crop:
+                entry["crop"] = crop
+            manifest.append(entry)
+        zf.writestr("manifest.json", json.dumps(manifest, indent=2))
+    return buf.getvalue(), "application/zip"
+
+def _multipart_response(results):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for result in results:
+        if result["status"] == 200:
+            headers = dict(result["headers"], **{"Content-Type": result["mimetype"]})
+            payload = result["body"]
+        else:
+            headers = {"Content-Type": "text/plain"}
+            payload = result["error"].encode()
+        headers["Content-Disposition"] = f'attachment; filename="{result["file"] or result["name"]}"'
+        headers["X-Status"] = str(result["status"])
+        head = "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+        parts.append(f"--{boundary}\r\n{head}\r\n".encode() + payload + b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/mixed; boundary={boundary}"
+
 @app.get("/")
 def health():
     return jsonify({"status": "ok"})
 
+@app.get("/metrics")
+def metrics():
+    return (render_metrics(), 200, {"Content-Type": "text/plain; version=0.0.4"})
+
+@app.after_request
+def _count_response(response):
+    RESPONSES.inc(endpoint=request.endpoint or "unknown", status=response.status_code)
+    return response
+
 @app.get("/ready")
 def ready():
     return jsonify({
         "ready": ready_event.is_set(),
         "error": preload_error is not None,
-        "message": preload_error or "ok"
+        "message": preload_error or "ok",
+        "models": model_registry.status(),
+        "startup": startup_phases,
     })
 
 @app.post("/remove-bg")
 def remove_bg():
-    file = request.files.get("image")
-    if not file:
-        return ("Missing 'image' file field", 400, {"Content-Type": "text/plain"})
-
-    # If model not ready yet, return a fast 503 instead of trying to import within request
-    if not ready_event.is_set():
-        return ("Model not ready, please retry in a few seconds", 503, {"Content-Type": "text/plain"})
-
-    # If preload failed, return 500 with explicit message for diagnosis
-    if preload_error is not None:
-        return (f"Model preload failed: {preload_error}", 500, {"Content-Type": "text/plain"})
+    timer = StageTimer()
+    try:
+        with timer.stage("upload"):
+            upload = _read_upload()
+        if upload is None:
+            return ("Missing 'image' file field", 400, {"Content-Type": "text/plain"})
+        opts = _parse_options()
+        body, mimetype, headers, cache_key, cache_status = _process(upload.getvalue(), opts, upload, timer)
+    except HTTPException:
+        # e.g. 413 from MAX_CONTENT_LENGTH while reading the body: use the registered handlers
+        raise
+    except Exception as e:
+        return _error_response(e)
+    headers = dict(headers, **{"Server-Timing": timer.server_timing(model=_model_key(opts["model"], opts["precision"]), cache=cache_status.lower())})
+    return _send_result(body, mimetype, headers, etag=cache_key, cache_status=cache_status)
 
-    if remove_fn is None or session is None:
-        return ("Model not loaded", 500, {"Content-Type": "text/plain"})
+@app.post("/remove-bg/batch")
+def remove_bg_batch():
+    try:
+        opts = _parse_options()
+        items = _batch_inputs()
+    except HTTPException:
+        raise
+    except Exception as e:
+        return _error_response(e)
+    results = list(batch_executor.map(lambda item: _batch_item(item[0], item[1], opts), items))
+    # Zip by default; multipart/mixed when the client prefers it
+    if request.accept_mimetypes.best_match(["application/zip", "multipart/mixed"]) == "multipart/mixed":
+        body, mimetype = _multipart_response(results)
+    else:
+        body, mimetype = _zip_response(results)
+    return app.response_class(body, content_type=mimetype)
 
+@app.post("/jobs")
+def submit_job():
     try:
-        # Read the image from the uploaded file
-        img = Image.open(file.stream).convert("RGBA")
-        img = downscale_if_needed(img, max_dim=800)
+        upload = _read_upload()
+        if upload is None:
+            return ("Missing 'image' file field", 400, {"Content-Type": "text/plain"})
+        job = job_store.submit(upload.getvalue(), _parse_options())
+    except HTTPException:
+        raise
+    except Exception as e:
+        return _error_response(e)
+    job["status_url"] = f"/jobs/{job['id']}"
+    job["result_url"] = f"/jobs/{job['id']}/result"
+    return jsonify(job), 202, {"Location": job["status_url"]}
 
-        # Remove background using rembg (returns PIL Image)
-        out_img = remove_fn(img, session=session)
+@app.get("/jobs/<job_id>")
+def job_status(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return ("Job not found or expired", 404, {"Content-Type": "text/plain"})
+    return jsonify(JobStore.describe(job))
 
-        # Encode as PNG bytes
-        buf = io.BytesIO()
-        out_img.save(buf, format="PNG")
-        buf.seek(0)
-        return send_file(buf, mimetype="image/png")
-    except Exception as e:
-        # Return plaintext error for easier client-side logging
-        return (str(e), 500, {"Content-Type": "text/plain"})
+@app.get("/jobs/<job_id>/result")
+def job_result(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return ("Job not found or expired", 404, {"Content-Type": "text/plain"})
+    if job["status"] == "failed":
+        return (job["error"], job["status_code"], {"Content-Type": "text/plain"})
+    if job["status"] != "done":
+        return (f"Job is {job['status']}, poll /jobs/{job_id} until it is done", 409, {"Content-Type": "text/plain"})
+    body, mimetype, headers, cache_key = job["result"]
+    return _send_result(body, mimetype, headers, etag=cache_key, cache_status="JOB")
 
 if __name__ == "__main__":
     # Local dev run: python server.py
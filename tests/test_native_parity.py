@@ -0,0 +1,70 @@
+"""Parity of the native engine's preprocessing, mask postprocessing and cutout with rembg's own code.
+
+    python -m pytest tests
+"""
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from PIL import Image
+
+# The model preload is not needed; these tests only exercise the array code
+os.environ.setdefault("REMBG_DEFER_PRELOAD", "1")
+
+import server
+
+pytest.importorskip("rembg")
+from rembg.bg import naive_cutout
+
+class RecordingInnerSession:
+    """Stands in for the ONNX Runtime session: records the model input and returns a fixed prediction."""
+
+    def __init__(self, pred: np.ndarray):
+        self.pred = pred
+        self.feed = None
+
+    def get_inputs(self):
+        return [SimpleNamespace(name="input.1", shape=[1, 3, *self.pred.shape[2:]])]
+
+    def run(self, output_names, feed):
+        self.feed = feed
+        return [self.pred]
+
+def make_photo(size=(517, 389), seed=0) -> Image.Image:
+    rng = np.random.default_rng(seed)
+    w, h = size
+    gradient = np.linspace(0, 255, w, dtype=np.float32)[None, :, None]
+    noise = rng.integers(-40, 40, (h, w, 4))
+    rgba = np.clip(gradient + noise, 0, 255).astype(np.uint8)
+    rgba[:, :, 3] = 255
+    return Image.fromarray(rgba, "RGBA")
+
+@pytest.mark.parametrize("model_name", ["u2netp", "u2net", "isnet-general-use"])
+def test_preprocess_and_postprocess_match_rembg(model_name):
+    img = make_photo()
+    (h, w), _, _ = server.MODEL_INPUTS[model_name]
+    pred = np.random.default_rng(1).standard_normal((1, 1, h, w)).astype(np.float32)
+    inner = RecordingInnerSession(pred)
+
+    rembg_mask = server._rembg_session(server.OrtSession(model_name, inner, "")).predict(img)[0]
+    rembg_input = inner.feed["input.1"][0]
+
+    native_input = np.empty((3, h, w), dtype=np.float32)
+    server._preprocess_into(native_input, img, model_name)
+    np.testing.assert_allclose(native_input, rembg_input, rtol=1e-5, atol=1e-5)
+
+    native_mask = server._postprocess(pred[0, 0], img.size)
+    assert native_mask.size == rembg_mask.size
+    diff = np.abs(np.asarray(native_mask, dtype=np.int16) - np.asarray(rembg_mask, dtype=np.int16))
+    assert diff.max() <= 1
+
+def test_composite_matches_naive_cutout():
+    img = make_photo(seed=2)
+    alpha = np.random.default_rng(3).integers(0, 256, (img.height, img.width), dtype=np.uint8)
+    mask = Image.fromarray(alpha, "L")
+
+    native = np.asarray(server._composite(img, mask), dtype=np.int16)
+    rembg = np.asarray(naive_cutout(img, mask), dtype=np.int16)
+    assert native.shape == rembg.shape
+    assert np.abs(native - rembg).max() <= 1